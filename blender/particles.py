@@ -1,10 +1,17 @@
+import hashlib
 import os
-import random
+import zipfile
 
 import blender.utilities
 import bpy
 import numpy as np
+import output_utilities
+import placement_utilities
+import profiling_utilities
 import trimesh
+from recipe_utilities import get_random_generator
+
+MAX_SEED = 2147483647
 
 
 def is_iterable(obj):
@@ -29,6 +36,8 @@ def ensure_double_iterability(obj):
     elif not is_iterable(obj[0]):
         return [obj]
 
+    return obj
+
 
 def select_only(particles):
     particles = ensure_iterability(particles)
@@ -40,15 +49,17 @@ def select_only(particles):
         particle.select_set(True)
 
 
-def create_raw_dummy_mesh():
+def create_raw_dummy_mesh(rng=None):
     mesh_raw = trimesh.creation.icosphere(subdivisions=5, radius=50)
 
-    np.random.seed(1)
+    if rng is None:
+        rng = np.random.default_rng(1)
+
     deformation_strength = 0.5
     n_vertices = len(mesh_raw.vertices)
     vertex_offsets = (
         mesh_raw.vertex_normals
-        * np.random.randn(n_vertices, 1)
+        * rng.standard_normal((n_vertices, 1))
         * deformation_strength
     )
     mesh_raw.vertices += vertex_offsets
@@ -68,78 +79,632 @@ def show(particles, state=True):
     hide(particles, state=(not state))
 
 
-def load_primitive(blend_file):
-    blend_file = os.path.abspath(blend_file)
+def _get_object_indices(particles):
+    object_indices = {
+        instance.as_pointer(): index
+        for index, instance in enumerate(bpy.data.objects)
+    }
 
-    assert os.path.isfile(blend_file), "Could not find file: " + blend_file
+    return np.array(
+        [object_indices[particle.as_pointer()] for particle in particles],
+        dtype=int,
+    )
 
-    section = "\\Object\\"
-    blender_object = "primitive"
 
-    filepath = blend_file + section + blender_object
-    directory = blend_file + section
-    filename = blender_object
+def _use_bulk_access(particles):
+    # Bulk access always covers all objects, which costs about as much per
+    # object as direct access per particle. Hence, it only pays off if the
+    # particles make up a considerable part of all objects.
+    return 4 * len(particles) >= len(bpy.data.objects)
 
-    bpy.ops.wm.append(
-        filepath=filepath, filename=filename, directory=directory
-    )
 
-    primitive = bpy.data.objects[-1]
+def _get_object_vectors(particles, attribute):
+    if not _use_bulk_access(particles):
+        return np.array(
+            [getattr(particle, attribute) for particle in particles],
+            dtype=np.float32,
+        ).reshape(-1, 3)
+
+    objects = bpy.data.objects
+    buffer = np.empty(len(objects) * 3, dtype=np.float32)
+    objects.foreach_get(attribute, buffer)
+
+    return buffer.reshape(-1, 3)[_get_object_indices(particles)]
+
+
+def _set_object_vectors(particles, attribute, values):
+    if not _use_bulk_access(particles):
+        for particle, value in zip(particles, values):
+            setattr(particle, attribute, value)
+
+        return
+
+    # foreach_set can only address complete collections, so the vectors of
+    # all objects are read, partially overwritten and written back at once.
+    objects = bpy.data.objects
+    buffer = np.empty(len(objects) * 3, dtype=np.float32)
+    objects.foreach_get(attribute, buffer)
+
+    buffer = buffer.reshape(-1, 3)
+    buffer[_get_object_indices(particles)] = values
+    objects.foreach_set(attribute, buffer.ravel())
+
+    # Bulk access bypasses the update callbacks of the properties.
+    for particle in particles:
+        particle.update_tag(refresh={"OBJECT"})
+
+
+def _ensure_vector_array(values, num_particles):
+    values = np.asarray(values, dtype=float)
+
+    if values.ndim < 2:
+        values = np.broadcast_to(values, (3,))
+
+    values = np.broadcast_to(values, (num_particles, 3))
+
+    return values
+
+
+def set_locations(particles, locations):
+    """Set the locations of many particles at once.
+
+    locations is an (N, 3) array or a single location for all particles.
+    """
+    particles = ensure_iterability(particles)
+
+    if not len(particles):
+        return
+
+    invalidate_geometry_cache(particles)
+    locations = _ensure_vector_array(locations, len(particles))
+    _set_object_vectors(particles, "location", locations)
+
+
+def set_rotations(particles, rotations_euler):
+    """Set the euler rotations of many particles at once.
+
+    rotations_euler is an (N, 3) array or a single rotation for all
+    particles.
+    """
+    particles = ensure_iterability(particles)
+
+    if not len(particles):
+        return
+
+    invalidate_geometry_cache(particles)
+    rotations_euler = _ensure_vector_array(rotations_euler, len(particles))
+    _set_object_vectors(particles, "rotation_euler", rotations_euler)
+
+
+def set_scales(particles, scales):
+    particles = ensure_iterability(particles)
+
+    if not len(particles):
+        return
+
+    invalidate_geometry_cache(particles)
+    scales = _ensure_vector_array(scales, len(particles))
+    _set_object_vectors(particles, "scale", scales)
+
+
+def _append_primitive(blend_file):
+    with bpy.data.libraries.load(blend_file, link=False) as (
+        data_from,
+        data_to,
+    ):
+        assert "primitive" in data_from.objects, (
+            "Expected file to contain an object called 'primitive': "
+            + blend_file
+        )
+        data_to.objects = ["primitive"]
+
+    return data_to.objects[0]
+
+
+class PrimitiveCache:
+    """Cache of primitives, which appends every .blend file only once.
+
+    The cached primitives are templates: They are not linked to the scene,
+    hidden and all their datablocks have a fake user, so that they survive
+    scene resets and data purges. Entries are keyed by the absolute path and
+    the modification time of the .blend file.
+    """
+
+    def __init__(self):
+        self.templates = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, blend_file):
+        blend_file = os.path.abspath(blend_file)
+
+        assert os.path.isfile(blend_file), (
+            "Could not find file: " + blend_file
+        )
+
+        key = (blend_file, os.path.getmtime(blend_file))
+        template = self.templates.get(key)
+
+        if template is not None and _is_valid(template):
+            self.hits += 1
+            return template
+
+        self.misses += 1
+
+        datablock_pointers = blender.utilities.get_datablock_pointers()
+        template = _append_primitive(blend_file)
+
+        for datablock in blender.utilities.get_new_datablocks(
+            datablock_pointers
+        ):
+            datablock.use_fake_user = True
+
+        hide(template)
+        self.templates[key] = template
+
+        return template
+
+    def clear(self):
+        self.templates.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def _is_valid(datablock):
+    # References to datablocks become invalid, if the datablock was removed
+    # or if a different .blend file was loaded.
+    try:
+        _ = datablock.name
+    except ReferenceError:
+        return False
+    else:
+        return True
+
+
+primitive_cache = PrimitiveCache()
+
+
+@profiling_utilities.profiled()
+def load_primitive(blend_file, use_cache=True):
+    """Load the object called "primitive" from a .blend file.
+
+    If use_cache is True, then a hidden template, which is not linked to the
+    scene, is returned from the primitive cache. It is meant to be
+    duplicated. Otherwise, the primitive is appended and linked to the scene
+    on every call.
+    """
+    if use_cache:
+        return primitive_cache.get(blend_file)
+
+    blend_file = os.path.abspath(blend_file)
+
+    assert os.path.isfile(blend_file), "Could not find file: " + blend_file
+
+    primitive = _append_primitive(blend_file)
+    bpy.data.scenes["Scene"].collection.objects.link(primitive)
 
     return primitive
 
 
+@profiling_utilities.profiled()
 def duplicate(particle, new_name):
     new_particle = particle.copy()
     new_particle.data = particle.data.copy()
     new_particle.animation_data_clear()
     new_particle.name = new_name
 
+    # Duplicates of cached primitives must not inherit their fake users.
+    new_particle.use_fake_user = False
+    new_particle.data.use_fake_user = False
+
     for i, particle_system in enumerate(particle.particle_systems):
         new_particle.particle_systems[
             i
         ].settings = particle_system.settings.copy()
+        new_particle.particle_systems[i].settings.use_fake_user = False
 
     bpy.data.scenes["Scene"].collection.objects.link(new_particle)
 
+    _track_particle_datablocks([new_particle])
+
     return new_particle
 
 
+def _track_particle_datablocks(particles):
+    """Register the datablocks of particles for purge_unused_data."""
+    blender.utilities.track_datablocks(particles, "objects")
+    blender.utilities.track_datablocks(
+        [particle.data for particle in particles if particle.data],
+        "meshes",
+    )
+    blender.utilities.track_datablocks(
+        [
+            particle_system.settings
+            for particle in particles
+            for particle_system in particle.particle_systems
+        ],
+        "particles",
+    )
+
+
+def instantiate(
+    primitive, n, name, particle_class=None, shape_variants=None, rng=None
+):
+    """Create n particles from a primitive in one call.
+
+    In contrast to duplicate, the particles share their mesh data: Either
+    the one of the primitive or, if a list of meshes is passed as
+    shape_variants, a randomly chosen one of these pre-baked shapes. Every
+    particle still has its own transformation, class and (for hair) particle
+    settings.
+    """
+    if shape_variants is not None:
+        assert not is_hair(
+            primitive
+        ), "Shape variants are not supported for hair objects."
+        assert shape_variants, "Expected at least one shape variant."
+
+        rng = get_random_generator(rng)
+        variant_ids = rng.integers(len(shape_variants), size=n)
+
+    collection = bpy.data.scenes["Scene"].collection
+
+    particles = list()
+
+    for particle_id in range(n):
+        particle = primitive.copy()
+        particle.animation_data_clear()
+        particle.name = name + "{:06d}".format(particle_id)
+        particle.use_fake_user = False
+
+        if shape_variants is not None:
+            particle.data = shape_variants[variant_ids[particle_id]]
+
+            # The shape variants already contain the baked modifiers.
+            for modifier in list(particle.modifiers):
+                particle.modifiers.remove(modifier)
+
+        for i, particle_system in enumerate(primitive.particle_systems):
+            settings = particle_system.settings.copy()
+            settings.use_fake_user = False
+            particle.particle_systems[i].settings = settings
+
+        if particle_class is not None:
+            particle["class"] = particle_class
+
+        collection.objects.link(particle)
+        particles.append(particle)
+
+    # Shared meshes are not tracked, since they outlive the particles.
+    blender.utilities.track_datablocks(particles, "objects")
+    blender.utilities.track_datablocks(
+        [
+            particle_system.settings
+            for particle in particles
+            for particle_system in particle.particle_systems
+        ],
+        "particles",
+    )
+
+    return particles
+
+
+def _get_orphaned_datablocks(datablocks):
+    """Return the datablocks, whose users are all in the given list (with
+    repetitions), i.e. which are unused once these users are deleted.
+    """
+    datablocks = [datablock for datablock in datablocks if datablock]
+    num_deleted_users = dict()
+
+    for datablock in datablocks:
+        pointer = datablock.as_pointer()
+        num_deleted_users[pointer] = num_deleted_users.get(pointer, 0) + 1
+
+    orphaned_datablocks = []
+
+    for datablock in datablocks:
+        pointer = datablock.as_pointer()
+
+        # Fake users count as users, so datablocks with one are kept.
+        if num_deleted_users.pop(pointer, None) == datablock.users:
+            orphaned_datablocks.append(datablock)
+
+    return orphaned_datablocks
+
+
 def delete(particles):
+    """Delete particles together with the meshes and particle settings that
+    are left without users, in a single bpy.data.batch_remove call.
+    Afterwards, the remaining unused tracked datablocks are purged (see
+    blender.utilities.purge_unused_data).
+
+    Returns the number of deleted datablocks per collection of bpy.data.
+    """
     particles = ensure_iterability(particles)
+    invalidate_geometry_cache(particles)
+
+    meshes = _get_orphaned_datablocks(
+        [particle.data for particle in particles]
+    )
+    particle_settings = _get_orphaned_datablocks(
+        [
+            particle_system.settings
+            for particle in particles
+            for particle_system in particle.particle_systems
+        ]
+    )
+
+    # Data of the deleted meshes (e.g. materials) may be left unused as
+    # well, so it is purged afterwards (at the end of a deferred_purge
+    # block, if any).
+    blender.utilities.track_datablocks(
+        [
+            material
+            for mesh in meshes
+            for material in mesh.materials
+            if material
+        ],
+        "materials",
+    )
 
-    bpy.ops.object.delete({"selected_objects": particles})
+    bpy.data.batch_remove(list(particles) + meshes + particle_settings)
     blender.utilities.purge_unused_data()
 
+    num_deleted_datablocks = {
+        "objects": len(particles),
+        "meshes": len(meshes),
+        "particles": len(particle_settings),
+    }
 
-def randomize_shape(particles):
+    for collection_name, n in num_deleted_datablocks.items():
+        profiling_utilities.count(f"datablocks_deleted/{collection_name}", n)
+
+    return num_deleted_datablocks
+
+
+@profiling_utilities.profiled()
+def randomize_shape(particles, rng=None):
     particles = ensure_iterability(particles)
+    rng = get_random_generator(rng)
+
+    invalidate_geometry_cache(particles)
 
     for particle in particles:
         if is_hair(particle):
-            particle.particle_systems[0].seed = random.randint(0, 2147483647)
-            particle.particle_systems[0].child_seed = random.randint(
-                0, 2147483647
-            )
+            seed, child_seed = rng.integers(MAX_SEED, size=2, endpoint=True)
+            particle.particle_systems[0].seed = int(seed)
+            particle.particle_systems[0].child_seed = int(child_seed)
         else:
             previous_location = tuple(particle.location)
 
-            range_limit = 1e10
-
-            x = random.randint(0, range_limit)
-            y = random.randint(0, range_limit)
-            z = random.randint(0, range_limit)
+            range_limit = int(1e10)
 
             # Move particle to randomize global noises.
-            particle.location = (x, y, z)
+            particle.location = rng.integers(
+                range_limit, size=3, endpoint=True
+            )
             select_only(particle)
             bpy.context.view_layer.objects.active = particle
             bpy.ops.object.convert(target="MESH")
 
+            # The converted mesh replaces the tracked, now unused copy.
+            blender.utilities.track_datablocks([particle.data], "meshes")
+
             # Reset location.
             particle.location = previous_location
 
 
+# In-process cache of shape variant pools, which maps (primitive hash, number
+# of variants, seed) to lists of meshes.
+_shape_variant_pools = dict()
+
+
+def _hash_primitive(primitive):
+    hasher = hashlib.sha1()
+
+    mesh = primitive.data
+    coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coordinates)
+    hasher.update(coordinates.tobytes())
+
+    for modifier in primitive.modifiers:
+        hasher.update(modifier.type.encode())
+
+        for rna_property in modifier.bl_rna.properties:
+            if rna_property.identifier in ["rna_type", "name"]:
+                continue
+
+            value = getattr(modifier, rna_property.identifier)
+
+            if rna_property.type == "POINTER":
+                value = getattr(value, "name", None)
+            elif getattr(rna_property, "is_array", False):
+                value = tuple(value)
+
+            hasher.update(repr(value).encode())
+
+    return hasher.hexdigest()
+
+
+def _bake_shape_variant(primitive, name, rng):
+    particle = duplicate(primitive, name)
+    show(particle)
+    copied_mesh = particle.data
+
+    randomize_shape(particle, rng)
+
+    mesh = particle.data
+    mesh.name = name
+    bpy.data.objects.remove(particle)
+
+    if copied_mesh != mesh and not copied_mesh.users:
+        bpy.data.meshes.remove(copied_mesh)
+
+    return mesh
+
+
+_SHAPE_VARIANT_ARRAY_NAMES = [
+    "coordinates",
+    "loop_vertices",
+    "loop_starts",
+    "loop_totals",
+    "use_smooth",
+    "material_indices",
+]
+
+
+def _save_shape_variants(meshes, file_path):
+    arrays = dict()
+
+    for variant_id, mesh in enumerate(meshes):
+        coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", coordinates)
+
+        loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loop_vertices)
+
+        loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_starts)
+
+        loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", loop_totals)
+
+        use_smooth = np.empty(len(mesh.polygons), dtype=bool)
+        mesh.polygons.foreach_get("use_smooth", use_smooth)
+
+        material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("material_index", material_indices)
+
+        arrays[f"coordinates_{variant_id}"] = coordinates
+        arrays[f"loop_vertices_{variant_id}"] = loop_vertices
+        arrays[f"loop_starts_{variant_id}"] = loop_starts
+        arrays[f"loop_totals_{variant_id}"] = loop_totals
+        arrays[f"use_smooth_{variant_id}"] = use_smooth
+        arrays[f"material_indices_{variant_id}"] = material_indices
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    # Other workers must never load a partially written file.
+    with output_utilities.atomic_file_path(file_path) as temporary_file_path:
+        np.savez(temporary_file_path, **arrays)
+
+
+def _load_shape_variants(primitive, file_path, num_variants, name):
+    # Read all arrays first, so that no meshes are created, if the file is
+    # incomplete.
+    with np.load(file_path) as arrays:
+        variant_arrays = [
+            {
+                array_name: arrays[f"{array_name}_{variant_id}"]
+                for array_name in _SHAPE_VARIANT_ARRAY_NAMES
+            }
+            for variant_id in range(num_variants)
+        ]
+
+    meshes = list()
+
+    for variant_id, variant in enumerate(variant_arrays):
+        mesh = bpy.data.meshes.new(f"{name}{variant_id:06d}")
+        mesh.vertices.add(len(variant["coordinates"]) // 3)
+        mesh.vertices.foreach_set("co", variant["coordinates"])
+        mesh.loops.add(len(variant["loop_vertices"]))
+        mesh.loops.foreach_set("vertex_index", variant["loop_vertices"])
+        mesh.polygons.add(len(variant["loop_starts"]))
+        mesh.polygons.foreach_set("loop_start", variant["loop_starts"])
+        mesh.polygons.foreach_set("loop_total", variant["loop_totals"])
+        mesh.polygons.foreach_set("use_smooth", variant["use_smooth"])
+        mesh.polygons.foreach_set(
+            "material_index", variant["material_indices"]
+        )
+        mesh.update(calc_edges=True)
+
+        for material in primitive.data.materials:
+            mesh.materials.append(material)
+
+        meshes.append(mesh)
+
+    return meshes
+
+
+def get_shape_variants(
+    primitive, num_variants, cache_directory=None, seed=0
+):
+    """Get a pool of num_variants randomized, baked meshes of a primitive.
+
+    The pool is created only once per process and its meshes have a fake
+    user, so that they survive scene resets. If a cache_directory is given,
+    then the pool is additionally stored there as .npz file, keyed by a hash
+    of the primitive (mesh and modifier settings) and num_variants. Only
+    geometry, smooth shading and materials (including the material index of
+    each polygon) are stored, UV maps are lost.
+
+    The number of variants trades the diversity of the particle shapes for
+    speed. Assign the pool via generate_lognormal_fraction or instantiate.
+
+    The variants are seeded with seed and the primitive hash, so that the
+    pool is the same in every process, independent of the image that first
+    requests it.
+    """
+    assert not is_hair(
+        primitive
+    ), "Shape variants are not supported for hair objects."
+    assert num_variants > 0, "Expected a positive number of shape variants."
+
+    primitive_hash = _hash_primitive(primitive)
+    key = (primitive_hash, num_variants, seed)
+
+    meshes = _shape_variant_pools.get(key)
+
+    if meshes is not None and all(_is_valid(mesh) for mesh in meshes):
+        return meshes
+
+    name = f"shape_variant_{primitive_hash[:8]}_"
+
+    file_path = None
+
+    if cache_directory is not None:
+        file_path = os.path.join(
+            cache_directory, f"{primitive_hash}_{num_variants}_{seed}.npz"
+        )
+
+    meshes = None
+
+    if file_path is not None and os.path.isfile(file_path):
+        try:
+            meshes = _load_shape_variants(
+                primitive, file_path, num_variants, name
+            )
+        except (
+            KeyError,
+            ValueError,
+            OSError,
+            zipfile.BadZipFile,
+            EOFError,
+        ):
+            # The cache is unreadable or was written by an older version
+            # (e.g. without material indices), so the variants are baked
+            # again.
+            meshes = None
+
+    if meshes is None:
+        rng = np.random.default_rng([seed, int(primitive_hash[:8], 16)])
+
+        meshes = [
+            _bake_shape_variant(primitive, f"{name}{variant_id:06d}", rng)
+            for variant_id in range(num_variants)
+        ]
+
+        if file_path is not None:
+            _save_shape_variants(meshes, file_path)
+
+    for mesh in meshes:
+        mesh.use_fake_user = True
+
+    _shape_variant_pools[key] = meshes
+
+    return meshes
+
+
 def is_hair(particle):
     if (
         not particle.particle_systems
@@ -149,43 +714,139 @@ def is_hair(particle):
         return particle.particle_systems[0].settings.type == "HAIR"
 
 
-def get_hair_spline_vertices(particles):
-    particles = ensure_iterability(particles)
+def get_evaluated_depsgraph():
+    # Blender 2.80 exposes the depsgraph directly, later versions evaluate
+    # it on demand.
+    if hasattr(bpy.context, "evaluated_depsgraph_get"):
+        return bpy.context.evaluated_depsgraph_get()
+
+    depsgraph = bpy.context.depsgraph
+    depsgraph.update()
+    return depsgraph
+
+
+def _get_hair_strand_ids(particle_system):
+    num_parents = len(particle_system.particles)
+    num_children = len(particle_system.child_particles)
+
+    # Like the conversion of hair to meshes, only use parent strands, if
+    # there are no children or if the parents are rendered explicitly.
+    if num_children and not particle_system.settings.use_parent_particles:
+        return range(num_parents, num_parents + num_children)
+
+    return range(num_parents + num_children)
+
+
+# Cache of the spline vertices of hair particles, which maps the pointer of
+# a particle to its geometry stamp and vertices.
+_spline_vertices_cache = dict()
+
+
+def _get_geometry_stamp(particle):
+    particle_system = particle.particle_systems[0]
+    settings = particle_system.settings
+
+    return (
+        particle.name,
+        particle_system.seed,
+        particle_system.child_seed,
+        settings.child_length,
+        settings.display_step,
+        tuple(particle.location),
+        tuple(particle.rotation_euler),
+        tuple(particle.scale),
+        bpy.context.scene.frame_current,
+    )
 
-    vertices_sets = []
+
+def invalidate_geometry_cache(particles):
+    particles = ensure_iterability(particles)
 
     for particle in particles:
+        _spline_vertices_cache.pop(particle.as_pointer(), None)
 
-        assert is_hair(particle), "Expected particle to be a hair object."
 
-        select_only(particle)
+def clear_geometry_cache():
+    _spline_vertices_cache.clear()
+
+
+def get_hair_spline_vertices(particles, use_cache=True):
+    """Get the vertices of the hair strands of each particle.
+
+    The vertices are read from the evaluated hair cache, without creating
+    temporary objects. For every particle, an (N, 3) array with the global
+    coordinates of the vertices of all its strands is returned.
+
+    If use_cache is True, then the vertices are cached per particle, until
+    its seed, length factor or transformation changes.
+    """
+    particles = ensure_iterability(particles)
+
+    vertices_sets = [None] * len(particles)
+    stamps = [None] * len(particles)
+    missing_ids = []
+
+    for particle_id, particle in enumerate(particles):
+        assert is_hair(particle), "Expected particle to be a hair object."
 
-        modifier_name = particle.particle_systems[0].name
+        if not use_cache:
+            missing_ids.append(particle_id)
+            continue
 
-        # TODO: Replace the conversion of the modifier to a mesh with a data, instead of an operation based approach.
-        bpy.ops.object.modifier_convert(modifier=modifier_name)
+        stamp = _get_geometry_stamp(particle)
+        stamps[particle_id] = stamp
+        stamp_cached, vertices = _spline_vertices_cache.get(
+            particle.as_pointer(), (None, None)
+        )
 
-        temp_object = bpy.context.view_layer.objects.active
-        temp_mesh = temp_object.data
+        if stamp_cached == stamp:
+            vertices_sets[particle_id] = vertices
+        else:
+            missing_ids.append(particle_id)
 
-        keypoints = []
+    if not missing_ids:
+        return vertices_sets
 
-        for vertex in temp_mesh.vertices:
-            keypoints.append([vertex.co.x, vertex.co.y, vertex.co.z])
+    depsgraph = get_evaluated_depsgraph()
 
-        vertices_sets.append(keypoints)
+    for particle_id in missing_ids:
+        particle = particles[particle_id]
+        vertices = _extract_hair_spline_vertices(particle, depsgraph)
+        vertices_sets[particle_id] = vertices
 
-        delete(temp_object)
+        if use_cache:
+            vertices.flags.writeable = False
+            _spline_vertices_cache[particle.as_pointer()] = (
+                stamps[particle_id],
+                vertices,
+            )
 
     return vertices_sets
 
 
+def _extract_hair_spline_vertices(particle, depsgraph):
+    # The strands of children (e.g. their kink and roughness) are only
+    # available from the evaluated hair cache, which can only be read
+    # vertex by vertex.
+    particle_evaluated = particle.evaluated_get(depsgraph)
+    particle_system = particle_evaluated.particle_systems[0]
+    co_hair = particle_system.co_hair
+
+    num_steps = 2 ** particle_system.settings.display_step + 1
+
+    return np.array(
+        [
+            co_hair(particle_evaluated, particle_no=strand_id, step=step)
+            for strand_id in _get_hair_strand_ids(particle_system)
+            for step in range(num_steps)
+        ]
+    ).reshape(-1, 3)
+
+
 def get_hair_spline_keypoints(particles):
     vertices_sets = get_hair_spline_vertices(particles)
 
-    keypoint_sets = [
-        [vertex[:2] for vertex in vertices] for vertices in vertices_sets
-    ]
+    keypoint_sets = [vertices[:, :2] for vertices in vertices_sets]
 
     return keypoint_sets
 
@@ -236,19 +897,22 @@ def get_hair_diameter(particles):
     return diameters
 
 
-def set_random_hair_length_factor(particles):
+def set_random_hair_length_factor(particles, rng=None):
     particles = ensure_iterability(particles)
+    invalidate_geometry_cache(particles)
+    rng = get_random_generator(rng)
 
     for particle in particles:
         assert is_hair(
             particle
         ), "Please use the set_size method for the sizing of non-hair objects."
 
-        particle.particle_systems[0].settings.child_length = random.random()
+        particle.particle_systems[0].settings.child_length = rng.random()
 
 
 def set_hair_length_factor(particles, length_factor):
     particles = ensure_iterability(particles)
+    invalidate_geometry_cache(particles)
 
     for particle in particles:
         assert is_hair(
@@ -261,18 +925,43 @@ def set_hair_length_factor(particles, length_factor):
 def set_size(particles, target_size_xyz):
     particles = ensure_iterability(particles)
 
-    if not is_iterable(target_size_xyz):
-        target_size_xyz = (target_size_xyz, target_size_xyz, target_size_xyz)
+    set_sizes(particles, target_size_xyz)
+
+
+def set_sizes(particles, target_sizes_xyz):
+    """Set the sizes of many particles at once.
+
+    target_sizes_xyz is either a single size or one size per particle, each
+    of which may be a scalar or an xyz-triple. A one-dimensional array of
+    length 3 is always interpreted as a single xyz-triple, so use an (N, 1)
+    array to pass one scalar per particle unambiguously.
+    """
+    particles = ensure_iterability(particles)
+
+    if not len(particles):
+        return
 
     for particle in particles:
         assert not is_hair(
             particle
         ), "Please use the set_hair_diameter and set_hair_length_factor methods for the sizing of hair objects."
 
-        scale_xyz = tuple(
-            a / b for a, b in zip(target_size_xyz, particle.dimensions)
-        )
-        particle.scale = scale_xyz
+    num_particles = len(particles)
+    target_sizes_xyz = np.asarray(target_sizes_xyz, dtype=float)
+
+    is_scalar_per_particle = (
+        target_sizes_xyz.ndim == 1
+        and len(target_sizes_xyz) == num_particles
+        and num_particles != 3
+    )
+
+    if is_scalar_per_particle:
+        target_sizes_xyz = target_sizes_xyz[:, np.newaxis]
+
+    target_sizes_xyz = np.broadcast_to(target_sizes_xyz, (num_particles, 3))
+
+    dimensions = _get_object_vectors(particles, "dimensions")
+    set_scales(particles, target_sizes_xyz / dimensions)
 
 
 def get_size(particles):
@@ -315,6 +1004,7 @@ def make_rigid(particles, state=True):
             )
 
 
+@profiling_utilities.profiled()
 def relax_collisions(particles, damping, collision_shape, n_frames):
     particles = ensure_iterability(particles)
 
@@ -345,61 +1035,187 @@ def place_randomly(
     lower_space_boundaries_xyz,
     upper_space_boundaries_xyz,
     do_random_rotation=False,
+    rng=None,
 ):
     particles = ensure_iterability(particles)
+    rng = get_random_generator(rng)
+
+    random_locations = rng.integers(
+        low=lower_space_boundaries_xyz,
+        high=upper_space_boundaries_xyz,
+        size=(len(particles), 3),
+    )
+    set_locations(particles, random_locations)
+
+    if do_random_rotation:
+        rotate_randomly(particles, rng)
+
+
+def get_bounding_radii(particles):
+    """Get half the largest dimension of each particle.
+
+    In contrast to particle.dimensions, this does not require an update of
+    the scene after the particle was scaled.
+    """
+    particles = ensure_iterability(particles)
+
+    radii = []
 
     for particle in particles:
-        random_location = tuple(
-            np.random.randint(
-                low=lower_space_boundaries_xyz, high=upper_space_boundaries_xyz
+        bound_box = np.array(particle.bound_box)
+        extent = (bound_box.max(axis=0) - bound_box.min(axis=0)) * np.abs(
+            particle.scale
+        )
+        radii.append(extent.max() / 2)
+
+    return np.array(radii)
+
+
+def place_without_overlaps(
+    particles,
+    lower_space_boundaries_xyz,
+    upper_space_boundaries_xyz,
+    method="random_sequential_addition",
+    max_overlap=0.0,
+    num_particles=None,
+    target_coverage=None,
+    do_random_rotation=False,
+    rng=None,
+):
+    """Place particles randomly, so that their bounding spheres do not
+    overlap by more than max_overlap (fraction of the sum of their radii).
+
+    This is a fast alternative to place_randomly and relax_collisions.
+    method is either "random_sequential_addition" or "repulsion" (see
+    placement_utilities).
+
+    Either num_particles or target_coverage (fraction of the xy-region,
+    which is covered by the projected bounding spheres) may be given, to
+    place only the first particles and delete the remaining ones. Returns
+    the placed particles and the number of them that could not be placed
+    without (excessive) overlaps.
+    """
+    particles = list(ensure_iterability(particles))
+    rng = get_random_generator(rng)
+
+    placement_functions = {
+        "random_sequential_addition": (
+            placement_utilities.place_by_random_sequential_addition
+        ),
+        "repulsion": placement_utilities.place_by_repulsion,
+    }
+
+    assert (
+        method in placement_functions
+    ), f"Unknown placement method: {method}"
+    assert (
+        num_particles is None or target_coverage is None
+    ), "num_particles and target_coverage are mutually exclusive."
+
+    radii = get_bounding_radii(particles)
+
+    if target_coverage is not None:
+        num_particles = (
+            placement_utilities.get_number_of_spheres_for_coverage(
+                radii,
+                lower_space_boundaries_xyz,
+                upper_space_boundaries_xyz,
+                target_coverage,
             )
         )
-        particle.location = random_location
+
+    if num_particles is not None and num_particles < len(particles):
+        delete(particles[num_particles:])
+        particles = particles[:num_particles]
+        radii = radii[:num_particles]
+
+    positions, num_overlapping = placement_functions[method](
+        radii,
+        lower_space_boundaries_xyz,
+        upper_space_boundaries_xyz,
+        max_overlap=max_overlap,
+        rng=rng,
+    )
+
+    place(particles, positions)
 
     if do_random_rotation:
-        rotate_randomly(particles)
+        rotate_randomly(particles, rng)
+
+    return particles, num_overlapping
 
 
 def place(particles, positions):
     particles = ensure_iterability(particles)
-    positions = ensure_double_iterability(positions)
+    positions = np.reshape(positions, (-1, 3))
 
-    for particle, position in zip(particles, positions):
-        particle.location = tuple(position)
+    set_locations(particles, positions)
 
 
-def rotate_randomly(particles):
+def rotate_randomly(particles, rng=None):
     particles = ensure_iterability(particles)
+    rng = get_random_generator(rng)
 
-    for particle in particles:
-        random_rotation = tuple(np.random.rand(3) * 2 * np.pi)
-        particle.rotation_euler = random_rotation
+    random_rotations = rng.random((len(particles), 3)) * 2 * np.pi
+    set_rotations(particles, random_rotations)
 
 
 def generate_lognormal_fraction(
-    primitive, name, n, d_g, sigma_g, particle_class="particle"
+    primitive,
+    name,
+    n,
+    d_g,
+    sigma_g,
+    particle_class="particle",
+    do_randomize_shape=True,
+    shape_variants=None,
+    rng=None,
 ):
-    hide(primitive, False)
+    """Create n particles with a lognormal size distribution.
 
-    particles = list()
+    By default, every particle gets its own, randomized copy of the mesh of
+    the primitive. For large fractions, it is much faster to either disable
+    do_randomize_shape, so that all particles share the mesh of the
+    primitive, or to pass a pool of pre-baked shape_variants.
+    """
+    hide(primitive, False)
+    rng = get_random_generator(rng)
 
     mu_particle_size = np.log(d_g)
     sigma_particle_size = np.log(sigma_g)
 
+    if shape_variants is not None or not do_randomize_shape:
+        particles = instantiate(
+            primitive, n, name, particle_class, shape_variants, rng
+        )
+
+        sizes = rng.lognormal(
+            mean=mu_particle_size, sigma=sigma_particle_size, size=(n, 1)
+        )
+        set_sizes(particles, sizes)
+
+        hide(primitive)
+
+        return particles
+
+    particles = list()
+    sizes = list()
+
     for particle_id in range(n):
         particle_name = name + "{:06d}".format(particle_id)
         particle = duplicate(primitive, particle_name)
         particle["class"] = particle_class
 
-        randomize_shape(particle)
+        randomize_shape(particle, rng)
 
-        size = np.random.lognormal(
-            mean=mu_particle_size, sigma=sigma_particle_size
+        sizes.append(
+            rng.lognormal(mean=mu_particle_size, sigma=sigma_particle_size)
         )
-        set_size(particle, size)
 
         particles.append(particle)
 
+    set_sizes(particles, np.reshape(sizes, (-1, 1)))
+
     hide(primitive)
 
     return particles
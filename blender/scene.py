@@ -1,29 +1,241 @@
+import functools
 import os
 import tempfile
 from pathlib import Path
 
 import bpy
+import numpy as np
 import pandas as pd
 from PIL import Image
 
 import blender.particles
+import blender.utilities
+import mask_utilities
+import output_utilities
+import profiling_utilities
+import rasterization_utilities
 from recipe_utilities import get_random_string
 from spline_utilities import calculate_spline_length
 
 
+# Scene settings (relative to bpy.context.scene), which are restored when
+# resetting the scene in memory.
+_RESET_SCENE_SETTINGS = [
+    "render.engine",
+    "render.resolution_x",
+    "render.resolution_y",
+    "render.filepath",
+    "render.film_transparent",
+    "render.use_compositing",
+    "render.use_sequencer",
+    "render.dither_intensity",
+    "render.image_settings.file_format",
+    "render.image_settings.color_mode",
+    "render.image_settings.color_depth",
+    "render.image_settings.compression",
+    "render.image_settings.tiff_codec",
+    "render.image_settings.exr_codec",
+    "render.threads_mode",
+    "render.threads",
+    "render.tile_x",
+    "render.tile_y",
+    "render.use_persistent_data",
+    "cycles.samples",
+    "cycles.use_adaptive_sampling",
+    "cycles.adaptive_threshold",
+    "cycles.max_bounces",
+    "cycles.diffuse_bounces",
+    "cycles.glossy_bounces",
+    "cycles.transmission_bounces",
+    "cycles.transparent_max_bounces",
+    "cycles.use_denoising",
+    "eevee.taa_render_samples",
+    "display.render_aa",
+    "display.shading.light",
+    "display.shading.color_type",
+    "display.shading.single_color",
+    "display.shading.show_shadows",
+    "display.shading.show_cavity",
+    "display.shading.show_object_outline",
+    "display.shading.show_specular_highlight",
+    "display.shading.show_xray",
+    "display_settings.display_device",
+    "world.use_nodes",
+    "use_nodes",
+    "world.color",
+    "use_gravity",
+    "frame_end",
+]
+
+
+def _get_setting(owner, path):
+    *owner_path, attribute = path.split(".")
+
+    for name in owner_path:
+        owner = getattr(owner, name, None)
+
+        if owner is None:
+            return None, attribute
+
+    return owner, attribute
+
+
+def _copy_value(value):
+    if isinstance(value, (str, bytes, int, float, bool)):
+        return value
+
+    return tuple(value)
+
+
 class TemporaryState:
-    def __init__(self):
+    """Context manager, which restores the scene after a recipe modified it.
+
+    mode="memory" (default): Remember which datablocks existed on entering
+        and delete all datablocks that were created in the meantime on
+        exit, except for those with a fake user. Scene settings, camera
+        scales as well as visibility, colors and materials of preexisting
+        objects are snapshotted and restored.
+    mode="file": Save the scene to a temporary .blend file and reload it on
+        exit. Slow, but also undoes modifications of preexisting datablocks
+        that are not covered by the in-memory reset (e.g. deletions).
+    """
+
+    def __init__(self, mode="memory"):
+        assert mode in ["memory", "file"], f"Unknown mode: {mode}"
+
+        self.mode = mode
         self.original_path = bpy.data.filepath
         self.temporary_path = (
             self.original_path + "_state_" + get_random_string()
         )
 
     def __enter__(self):
-        bpy.ops.wm.save_as_mainfile(filepath=self.temporary_path)
+        # Purging unused data is postponed to the end of the state, where
+        # everything that was created is removed anyway.
+        self.deferred_purge = blender.utilities.deferred_purge()
+        self.deferred_purge.__enter__()
+
+        if self.mode == "file":
+            bpy.ops.wm.save_as_mainfile(filepath=self.temporary_path)
+        else:
+            self._take_snapshot()
 
     def __exit__(self, type, value, traceback):
-        bpy.ops.wm.open_mainfile(filepath=self.original_path)
-        os.remove(self.temporary_path)
+        if self.mode == "file":
+            bpy.ops.wm.open_mainfile(filepath=self.original_path)
+            os.remove(self.temporary_path)
+        else:
+            self._restore_snapshot()
+
+        blender.particles.clear_geometry_cache()
+        self.deferred_purge.__exit__(type, value, traceback)
+
+    def _take_snapshot(self):
+        scene = bpy.context.scene
+
+        self.datablock_pointers = blender.utilities.get_datablock_pointers()
+
+        self.had_rigidbody_world = scene.rigidbody_world is not None
+        self.frame_current = scene.frame_current
+
+        self.scene_settings = {}
+
+        for path in _RESET_SCENE_SETTINGS:
+            owner, attribute = _get_setting(scene, path)
+
+            if owner is not None and hasattr(owner, attribute):
+                self.scene_settings[path] = _copy_value(
+                    getattr(owner, attribute)
+                )
+
+        self.ortho_scales = {
+            camera.name: camera.ortho_scale for camera in bpy.data.cameras
+        }
+
+        self.object_states = {}
+
+        for instance in bpy.data.objects:
+            materials = None
+
+            if instance.type == "MESH":
+                materials = (
+                    list(instance.data.materials),
+                    [
+                        (material_slot.link, material_slot.material)
+                        for material_slot in instance.material_slots
+                    ],
+                )
+
+            self.object_states[instance.name] = (
+                instance.hide_viewport,
+                instance.hide_render,
+                tuple(instance.color),
+                materials,
+            )
+
+    def _restore_snapshot(self):
+        scene = bpy.context.scene
+
+        if not self.had_rigidbody_world and scene.rigidbody_world is not None:
+            bpy.ops.rigidbody.world_remove()
+
+        self._remove_new_datablocks()
+
+        for path, value in self.scene_settings.items():
+            owner, attribute = _get_setting(scene, path)
+
+            if owner is not None:
+                setattr(owner, attribute, value)
+
+        for camera_name, ortho_scale in self.ortho_scales.items():
+            bpy.data.cameras[camera_name].ortho_scale = ortho_scale
+
+        for object_name, state in self.object_states.items():
+            instance = bpy.data.objects.get(object_name)
+
+            if instance is None:
+                continue
+
+            hide_viewport, hide_render, color, materials = state
+            instance.hide_viewport = hide_viewport
+            instance.hide_render = hide_render
+            instance.color = color
+
+            if materials is not None:
+                mesh_materials, slot_materials = materials
+                instance.data.materials.clear()
+
+                for material in mesh_materials:
+                    instance.data.materials.append(material)
+
+                for material_slot, (link, material) in zip(
+                    instance.material_slots, slot_materials
+                ):
+                    material_slot.link = link
+
+                    if link == "OBJECT":
+                        material_slot.material = material
+
+        scene.frame_set(self.frame_current)
+
+    def _remove_new_datablocks(self):
+        new_datablocks = blender.utilities.get_new_datablocks(
+            self.datablock_pointers
+        )
+
+        for datablock in new_datablocks:
+            profiling_utilities.count(
+                f"datablocks_created/{type(datablock).__name__}"
+            )
+
+        # Datablocks with a fake user (e.g. cached primitives) are kept.
+        bpy.data.batch_remove(
+            [
+                datablock
+                for datablock in new_datablocks
+                if not datablock.use_fake_user
+            ]
+        )
 
 
 def set_background_color(color):
@@ -66,7 +278,104 @@ def enable_all_rendering_devices():
         device.use = True
 
 
-def apply_default_settings(engine="EEVEE"):
+# Performance presets of render settings (relative to bpy.context.scene),
+# which trade quality for throughput. Settings that do not exist in the
+# running Blender version (e.g. adaptive sampling before Blender 2.83) are
+# skipped.
+RENDER_PRESETS = {
+    "draft": {
+        "cycles.samples": 4,
+        "cycles.use_adaptive_sampling": False,
+        "cycles.adaptive_threshold": 0.1,
+        "cycles.max_bounces": 2,
+        "cycles.diffuse_bounces": 1,
+        "cycles.glossy_bounces": 1,
+        "cycles.transmission_bounces": 2,
+        "cycles.transparent_max_bounces": 4,
+        "cycles.use_denoising": False,
+        "eevee.taa_render_samples": 32,
+        "render.tile_x": 32,
+        "render.tile_y": 32,
+        "render.use_persistent_data": True,
+    },
+    "balanced": {
+        "cycles.samples": 32,
+        "cycles.use_adaptive_sampling": True,
+        "cycles.adaptive_threshold": 0.05,
+        "cycles.max_bounces": 4,
+        "cycles.diffuse_bounces": 2,
+        "cycles.glossy_bounces": 2,
+        "cycles.transmission_bounces": 4,
+        "cycles.transparent_max_bounces": 8,
+        "cycles.use_denoising": True,
+        "eevee.taa_render_samples": 64,
+        "render.tile_x": 32,
+        "render.tile_y": 32,
+        "render.use_persistent_data": True,
+    },
+    "quality": {
+        "cycles.samples": 128,
+        "cycles.use_adaptive_sampling": True,
+        "cycles.adaptive_threshold": 0.01,
+        "cycles.max_bounces": 12,
+        "cycles.diffuse_bounces": 4,
+        "cycles.glossy_bounces": 4,
+        "cycles.transmission_bounces": 12,
+        "cycles.transparent_max_bounces": 8,
+        "cycles.use_denoising": True,
+        "eevee.taa_render_samples": 128,
+        "render.tile_x": 64,
+        "render.tile_y": 64,
+        "render.use_persistent_data": False,
+    },
+}
+
+
+def _set_setting(owner, path, value):
+    owner, attribute = _get_setting(owner, path)
+
+    if owner is not None and hasattr(owner, attribute):
+        setattr(owner, attribute, value)
+
+
+def apply_render_preset(preset, threads=None):
+    """Apply one of the RENDER_PRESETS.
+
+    threads is the number of CPU threads used for rendering. None uses all
+    cores or the number passed to Blender via --threads, which render.py
+    sets when running multiple workers.
+    """
+    assert preset in RENDER_PRESETS, f"Unknown render preset: {preset}"
+
+    scene = bpy.context.scene
+
+    for path, value in RENDER_PRESETS[preset].items():
+        _set_setting(scene, path, value)
+
+    # Before Blender 2.90, denoising can only be set per view layer.
+    use_denoising = RENDER_PRESETS[preset]["cycles.use_denoising"]
+
+    for view_layer in scene.view_layers:
+        _set_setting(view_layer, "cycles.use_denoising", use_denoising)
+
+    if threads is None:
+        scene.render.threads_mode = "AUTO"
+    else:
+        scene.render.threads_mode = "FIXED"
+        scene.render.threads = threads
+
+
+def apply_default_settings(
+    engine="EEVEE", output_format=None, preset=None, threads=None
+):
+    """Apply the default settings of the scene.
+
+    output_format is the output_utilities.OutputFormat of rendered images
+    (default: output_utilities.DEFAULT_OUTPUT_FORMATS["image"]). If one of
+    the RENDER_PRESETS is selected, then it is applied with threads (see
+    apply_render_preset). Otherwise, only the sample count of the engine is
+    set and all other render settings of the scene are left untouched.
+    """
     engine = engine.upper()
 
     if engine == "EEVEE":
@@ -75,24 +384,33 @@ def apply_default_settings(engine="EEVEE"):
     bpy.context.scene.render.engine = engine
     enable_all_rendering_devices()
 
-    if engine == "CYCLES":
+    if preset is not None:
+        apply_render_preset(preset, threads)
+    elif engine == "CYCLES":
         bpy.context.scene.cycles.samples = 4
-    if engine == "BLENDER_EEVEE":
+    elif engine == "BLENDER_EEVEE":
         bpy.context.scene.eevee.taa_render_samples = 32
 
     bpy.context.scene.render.image_settings.color_mode = "RGBA"
-    bpy.context.scene.render.image_settings.color_depth = "8"
-    bpy.context.scene.render.image_settings.compression = 0
+    apply_output_format(
+        output_format or output_utilities.DEFAULT_OUTPUT_FORMATS["image"]
+    )
 
     bpy.context.scene.render.film_transparent = True
 
     bpy.context.scene.use_gravity = False
 
 
-def setup_workbench_renderer():
-    bpy.context.scene.render.image_settings.compression = 15
+def setup_workbench_renderer(output_format=None):
+    """Set up the flat shaded rendering of masks.
+
+    output_format is the output_utilities.OutputFormat of masks (default:
+    output_utilities.DEFAULT_OUTPUT_FORMATS["mask"]).
+    """
+    apply_output_format(
+        output_format or output_utilities.DEFAULT_OUTPUT_FORMATS["mask"]
+    )
     bpy.context.scene.render.image_settings.color_mode = "BW"
-    bpy.context.scene.render.image_settings.color_depth = "8"
     bpy.context.scene.render.use_compositing = False
     bpy.context.scene.render.use_sequencer = False
     bpy.context.scene.render.engine = "BLENDER_WORKBENCH"
@@ -107,21 +425,337 @@ def setup_workbench_renderer():
     bpy.context.scene.world.color = (0, 0, 0)
 
 
+# Formats of output_utilities.FILE_FORMATS, which Blender can write.
+_BLENDER_FILE_FORMATS = {"png": "PNG", "tiff": "TIFF", "exr": "OPEN_EXR"}
+
+
+def can_render_to_output_format(output_format):
+    return (
+        output_format.file_format in _BLENDER_FILE_FORMATS
+        and not output_format.pack_bits
+    )
+
+
+def apply_output_format(output_format):
+    """Apply an output_utilities.OutputFormat to the image settings, which
+    are used by render_to_file. Formats that Blender cannot write are
+    ignored, so that the previous settings are kept.
+    """
+    if not can_render_to_output_format(output_format):
+        return
+
+    image_settings = bpy.context.scene.render.image_settings
+    image_settings.file_format = _BLENDER_FILE_FORMATS[
+        output_format.file_format
+    ]
+
+    compression = output_format.compression
+
+    if output_format.file_format == "exr":
+        image_settings.color_depth = "16"
+        image_settings.exr_codec = "NONE" if compression == 0 else "ZIP"
+        return
+
+    image_settings.color_depth = "8"
+
+    if output_format.file_format == "png":
+        # Blender's default compression.
+        image_settings.compression = 15 if compression is None else compression
+    elif output_format.file_format == "tiff":
+        image_settings.tiff_codec = "DEFLATE" if compression else "NONE"
+
+
+def save_render(
+    absolute_file_path, output_format=None, writer=None, is_mask=False
+):
+    """Render the scene and save it in output_format.
+
+    The extension of absolute_file_path is replaced with the one of the
+    format and the resulting path is returned. Formats that Blender cannot
+    write are saved via render_to_variable, as well as all images, if an
+    output_utilities.OutputWriter is given, so that encoding does not block
+    Blender.
+    """
+    if output_format is None:
+        output_format = output_utilities.DEFAULT_OUTPUT_FORMATS[
+            "mask" if is_mask else "image"
+        ]
+
+    absolute_file_path = output_format.get_file_path(absolute_file_path)
+
+    if writer is None and can_render_to_output_format(output_format):
+        apply_output_format(output_format)
+        render_to_file(absolute_file_path)
+    else:
+        if is_mask:
+            pixels = _render_mask_to_variable()
+        else:
+            pixels = render_to_variable()
+
+        output_utilities.write(
+            writer, output_format.save, pixels, absolute_file_path
+        )
+
+    return absolute_file_path
+
+
+@profiling_utilities.profiled()
 def render_to_file(absolute_file_path):
     previous_path = bpy.context.scene.render.filepath
 
-    bpy.context.scene.render.filepath = str(absolute_file_path)
-    bpy.ops.render.render(write_still=True)
+    # Render to a temporary file, so that an interrupted render never leaves
+    # an incomplete file.
+    os.makedirs(os.path.dirname(str(absolute_file_path)), exist_ok=True)
+    with output_utilities.atomic_file_path(
+        absolute_file_path
+    ) as temporary_file_path:
+        bpy.context.scene.render.filepath = temporary_file_path
+        bpy.ops.render.render(write_still=True)
+
     bpy.context.scene.render.filepath = previous_path
 
 
-def render_to_variable():
-    temp_file_name = get_random_string() + ".png"
-    temp_file_path = os.path.join(tempfile.gettempdir(), temp_file_name)
-    render_to_file(temp_file_path)
-    image = Image.open(temp_file_path)
+_VIEWER_NODE_NAME = "render_to_variable"
+_temporary_directory = None
+
+
+@profiling_utilities.profiled()
+def render_to_variable(return_pil_image=False):
+    """Render the scene and return the result as uint8 RGBA array.
+
+    If possible, the pixels are read from the compositor's viewer node,
+    without touching the disk. The "Standard" and "Raw" view transforms are
+    applied in numpy, other view transforms (e.g. "Filmic") with the
+    optional PyOpenColorIO package and Blender's OpenColorIO configuration.
+    Dither is not applied to the viewer node pixels, so that they differ
+    slightly from files saved by Blender, if the dither intensity of the
+    scene is not 0. If the color management of the scene cannot be
+    reproduced (e.g. looks, exposure, gamma or curves), the image is
+    rendered to an uncompressed TIFF in a temporary directory, which is
+    removed again.
+
+    If return_pil_image is True, then a PIL image is returned instead.
+    """
+    pixels = None
+
+    display_transform = _get_display_transform()
 
-    return image
+    if display_transform is not None:
+        pixels = _render_to_viewer_pixels(display_transform)
+
+    if pixels is None:
+        pixels = _render_to_temporary_file()
+
+    if return_pil_image:
+        return Image.fromarray(pixels, mode="RGBA")
+
+    return pixels
+
+
+def _get_display_transform():
+    """Get a function, which applies the color management of the scene to
+    (N, 3) scene linear colors, or None, if it cannot be reproduced.
+    """
+    scene = bpy.context.scene
+    display_device = scene.display_settings.display_device
+    view_settings = scene.view_settings
+
+    if display_device == "None":
+        return _identity
+
+    if (
+        view_settings.look != "None"
+        or view_settings.exposure != 0
+        or view_settings.gamma != 1
+        or view_settings.use_curve_mapping
+    ):
+        return None
+
+    if view_settings.view_transform == "Raw":
+        return _identity
+
+    if display_device == "sRGB" and view_settings.view_transform == (
+        "Standard"
+    ):
+        return _linear_to_srgb
+
+    return _get_opencolorio_transform(
+        display_device, view_settings.view_transform
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_opencolorio_transform(display_device, view_transform):
+    try:
+        import PyOpenColorIO as opencolorio
+    except ImportError:
+        return None
+
+    config_path = os.environ.get("OCIO") or os.path.join(
+        bpy.utils.resource_path("LOCAL"),
+        "datafiles",
+        "colormanagement",
+        "config.ocio",
+    )
+
+    if not os.path.isfile(config_path):
+        return None
+
+    config = opencolorio.Config.CreateFromFile(config_path)
+
+    if view_transform not in config.getViews(display_device):
+        return None
+
+    processor = config.getProcessor(
+        opencolorio.DisplayViewTransform(
+            src=opencolorio.ROLE_SCENE_LINEAR,
+            display=display_device,
+            view=view_transform,
+        )
+    ).getDefaultCPUProcessor()
+
+    def display_transform(colors):
+        colors = np.ascontiguousarray(colors, dtype=np.float32)
+        processor.applyRGB(colors)
+        return colors
+
+    return display_transform
+
+
+def _identity(colors):
+    return colors
+
+
+def _setup_viewer_node():
+    scene = bpy.context.scene
+    scene.use_nodes = True
+    node_tree = scene.node_tree
+
+    viewer_node = node_tree.nodes.get(_VIEWER_NODE_NAME)
+
+    if viewer_node is None:
+        composite_node = next(
+            (node for node in node_tree.nodes if node.type == "COMPOSITE"),
+            None,
+        )
+
+        if composite_node is None:
+            composite_node = node_tree.nodes.new("CompositorNodeComposite")
+
+        if composite_node.inputs["Image"].is_linked:
+            output_socket = composite_node.inputs["Image"].links[0].from_socket
+        else:
+            render_layers_node = next(
+                (node for node in node_tree.nodes if node.type == "R_LAYERS"),
+                None,
+            ) or node_tree.nodes.new("CompositorNodeRLayers")
+            output_socket = render_layers_node.outputs["Image"]
+            node_tree.links.new(output_socket, composite_node.inputs["Image"])
+
+        viewer_node = node_tree.nodes.new("CompositorNodeViewer")
+        viewer_node.name = _VIEWER_NODE_NAME
+        viewer_node.use_alpha = True
+        node_tree.links.new(output_socket, viewer_node.inputs["Image"])
+
+    # Only the active viewer node writes to the "Viewer Node" image.
+    node_tree.nodes.active = viewer_node
+
+
+def _render_to_viewer_pixels(display_transform):
+    scene = bpy.context.scene
+    previous_use_nodes = scene.use_nodes
+    previous_use_compositing = scene.render.use_compositing
+
+    try:
+        _setup_viewer_node()
+        scene.render.use_compositing = True
+        bpy.ops.render.render()
+    finally:
+        scene.use_nodes = previous_use_nodes
+        scene.render.use_compositing = previous_use_compositing
+
+    viewer_image = bpy.data.images.get("Viewer Node")
+    width, height = _get_render_resolution()
+
+    if viewer_image is None or tuple(viewer_image.size) != (width, height):
+        return None
+
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    viewer_image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, 4)[::-1]
+
+    return _convert_viewer_pixels(pixels, display_transform)
+
+
+def _convert_viewer_pixels(pixels, display_transform):
+    """Apply the conversions of saving a render result to an 8 bit file,
+    except for dither.
+    """
+    colors = pixels[..., :3]
+    alphas = pixels[..., 3:]
+
+    # Render results are premultiplied, files are not.
+    np.divide(colors, alphas, out=colors, where=alphas > 0)
+
+    colors[...] = display_transform(colors.reshape(-1, 3)).reshape(
+        colors.shape
+    )
+
+    return np.round(np.clip(pixels, 0, 1) * 255).astype(np.uint8)
+
+
+def _linear_to_srgb(colors):
+    colors = np.clip(colors, 0, 1)
+    return np.where(
+        colors <= 0.0031308,
+        colors * 12.92,
+        1.055 * np.power(colors, 1 / 2.4) - 0.055,
+    )
+
+
+def _get_temporary_directory():
+    global _temporary_directory
+
+    # The directory and its content are removed at exit.
+    if _temporary_directory is None:
+        _temporary_directory = tempfile.TemporaryDirectory(
+            prefix="render_to_variable_"
+        )
+
+    return _temporary_directory.name
+
+
+def _render_to_temporary_file():
+    image_settings = bpy.context.scene.render.image_settings
+    previous_settings = {
+        attribute: getattr(image_settings, attribute)
+        for attribute in [
+            "file_format",
+            "tiff_codec",
+            "color_mode",
+            "color_depth",
+        ]
+    }
+
+    temporary_file_path = os.path.join(
+        _get_temporary_directory(), get_random_string() + ".tif"
+    )
+
+    try:
+        image_settings.file_format = "TIFF"
+        image_settings.tiff_codec = "NONE"
+        image_settings.color_mode = "RGBA"
+        image_settings.color_depth = "8"
+        render_to_file(temporary_file_path)
+
+        with Image.open(temporary_file_path) as image:
+            return np.array(image.convert("RGBA"))
+    finally:
+        for attribute, value in previous_settings.items():
+            setattr(image_settings, attribute, value)
+
+        if os.path.isfile(temporary_file_path):
+            os.remove(temporary_file_path)
 
 
 def save_annotation_file(annotation_file_path, particles, do_append=False):
@@ -142,7 +776,33 @@ def save_annotation_file(annotation_file_path, particles, do_append=False):
 
 
 # TODO: Adapt to render_occlusion_masks
-def render_object_masks(particles, image_id, absolute_output_directory):
+@profiling_utilities.profiled()
+def render_object_masks(
+    particles,
+    image_id,
+    absolute_output_directory,
+    mask_format="png",
+    writer=None,
+    output_format=None,
+    backend="render",
+):
+    """Render a mask of each complete particle, ignoring occlusions.
+
+    The masks are saved in one of the mask_utilities.MASK_FORMATS, except
+    for "label", which cannot represent overlapping masks. The "png" format
+    saves one file per mask in the output_utilities.OutputFormat
+    output_format (default: output_utilities.DEFAULT_OUTPUT_FORMATS["mask"]).
+    If an output_utilities.OutputWriter is given, then the files are written
+    in the background. The masks are created with one of the MASK_BACKENDS.
+
+    Returns the paths of the (possibly not yet written) files.
+    """
+    assert mask_format in [
+        "png",
+        "coco",
+    ], f"Unsupported mask format for object masks: {mask_format}"
+    assert backend in MASK_BACKENDS, f"Unknown mask backend: {backend}"
+
     absolute_output_directory = Path(absolute_output_directory)
 
     if not absolute_output_directory.is_absolute():
@@ -152,9 +812,23 @@ def render_object_masks(particles, image_id, absolute_output_directory):
 
     particles = blender.particles.ensure_iterability(particles)
 
+    if backend == "rasterize":
+        for particle in particles:
+            _assert_class_attribute(particle)
+
+        return mask_utilities.save_masks(
+            rasterize_object_masks(particles),
+            [particle["class"] for particle in particles],
+            image_id,
+            absolute_output_directory,
+            mask_format,
+            writer=writer,
+            output_format=output_format,
+        )
+
     # with TemporaryState():
     # Set render settings.
-    setup_workbench_renderer()
+    setup_workbench_renderer(output_format)
     bpy.context.scene.display.shading.color_type = "SINGLE"
     bpy.context.scene.display.shading.single_color = (1, 1, 1)
 
@@ -163,23 +837,47 @@ def render_object_masks(particles, image_id, absolute_output_directory):
         if instance.type == "MESH":
             instance.hide_render = True
 
+    masks = []
+    output_file_paths = []
+
     # Unhide relevant particles one by one and render them.
     for mask_id, particle in enumerate(particles):
         blender.particles.hide(particle, False)
 
-        assert "class" in particle, (
-            "You need to assign the class attribute of the particles before saving "
-            "annotations:\nExample: particle['class'] = 'test'"
-        )
+        _assert_class_attribute(particle)
 
-        output_filename = f"mask_{image_id}_{mask_id}.png"
-        output_file_path = (
-            absolute_output_directory / particle["class"] / output_filename
-        )
-        render_to_file(output_file_path)
+        if mask_format == "png":
+            output_filename = f"mask_{image_id}_{mask_id}.png"
+            output_file_path = (
+                absolute_output_directory / particle["class"] / output_filename
+            )
+            output_file_paths.append(
+                save_render(
+                    output_file_path, output_format, writer, is_mask=True
+                )
+            )
+        else:
+            masks.append(_render_mask_to_variable())
 
         blender.particles.hide(particle)
 
+    if mask_format != "png":
+        output_file_paths = mask_utilities.save_masks(
+            masks,
+            [particle["class"] for particle in particles],
+            image_id,
+            absolute_output_directory,
+            mask_format,
+            writer=writer,
+            output_format=output_format,
+        )
+
+    return output_file_paths
+
+
+def _render_mask_to_variable():
+    return render_to_variable()[..., 0] > 127
+
 
 def create_diffuse_color_material(name, color):
     material = bpy.data.materials.get(name) or bpy.data.materials.new(name)
@@ -188,11 +886,108 @@ def create_diffuse_color_material(name, color):
 
 
 def replace_material(instance, material):
-    instance.data.materials.clear()
-    instance.data.materials.append(material)
+    """Replace all materials of instance, without modifying its mesh.
+
+    The material slots are linked to the object, since the mesh may be
+    shared with other particles (see blender.particles.instantiate).
+    """
+    # Object materials need a slot of the mesh. An empty slot keeps the
+    # rendering of the other users of the mesh unchanged.
+    if not instance.material_slots:
+        instance.data.materials.append(None)
+
+    for material_slot in instance.material_slots:
+        material_slot.link = "OBJECT"
+        material_slot.material = material
+
+
+def _assert_class_attribute(particle):
+    assert "class" in particle, (
+        "You need to assign the class attribute of the particles before saving "
+        "annotations:\nExample: particle['class'] = 'test'"
+    )
+
+
+@profiling_utilities.profiled()
+def render_instance_label_image(particles):
+    """Render all particles in a single pass and return a label image.
+
+    Every particle is drawn in a flat, unique color, which encodes its id
+    (index in particles + 1). All other meshes are drawn in black, so that
+    they still occlude the particles. The returned integer array holds the
+    id of the visible particle for each pixel and 0 for the background.
+    """
+    particles = blender.particles.ensure_iterability(particles)
+
+    assert (
+        len(particles) <= mask_utilities.MAX_NUM_INSTANCES
+    ), "Too many particles for a single label image."
+
+    setup_workbench_renderer()
+    bpy.context.scene.render.image_settings.color_mode = "RGB"
+
+    shading = bpy.context.scene.display.shading
+    shading.color_type = "OBJECT"
+    shading.show_shadows = False
+    shading.show_cavity = False
+    shading.show_object_outline = False
+    shading.show_specular_highlight = False
+    shading.show_xray = False
+
+    for instance in bpy.data.objects:
+        if instance.type == "MESH":
+            instance.color = (0, 0, 0, 1)
+
+    colors = mask_utilities.encode_instance_ids_as_colors(
+        range(1, len(particles) + 1)
+    )
+
+    for particle, color in zip(particles, colors):
+        particle.color = (*color, 1)
+
+    image = render_to_variable()[..., :3]
+
+    return mask_utilities.decode_instance_label_image(image)
+
+
+@profiling_utilities.profiled()
+def render_occlusion_masks(
+    particles,
+    image_id,
+    absolute_output_directory,
+    mode="single_pass",
+    mask_format="png",
+    writer=None,
+    output_format=None,
+    backend="render",
+):
+    """Render a mask of the visible part of each particle.
 
+    mode="single_pass" (default): Render a single instance label image and
+        derive the masks from it.
+    mode="per_particle": Render each mask separately.
+
+    The masks are created with one of the MASK_BACKENDS. The "rasterize"
+    backend always creates a single instance label image, regardless of
+    the mode.
+
+    The masks are saved in one of the mask_utilities.MASK_FORMATS. The
+    default "png" format saves them as
+    absolute_output_directory/<class>/mask_<image_id>_<mask_id>.png
+    in the output_utilities.OutputFormat output_format (default:
+    output_utilities.DEFAULT_OUTPUT_FORMATS["mask"]).
+
+    If an output_utilities.OutputWriter is given, then the files are written
+    in the background.
+
+    Returns the paths of the (possibly not yet written) files.
+    """
+    assert mode in ["single_pass", "per_particle"], f"Unknown mode: {mode}"
+    assert backend in MASK_BACKENDS, f"Unknown mask backend: {backend}"
+    assert (
+        mask_format in mask_utilities.MASK_FORMATS
+    ), f"Unknown mask format: {mask_format}"
 
-def render_occlusion_masks(particles, image_id, absolute_output_directory):
     absolute_output_directory = Path(absolute_output_directory)
 
     if not absolute_output_directory.is_absolute():
@@ -202,9 +997,44 @@ def render_occlusion_masks(particles, image_id, absolute_output_directory):
 
     particles = blender.particles.ensure_iterability(particles)
 
+    for particle in particles:
+        _assert_class_attribute(particle)
+
+    instance_classes = [particle["class"] for particle in particles]
+
+    if backend == "rasterize" or mode == "single_pass":
+        if backend == "rasterize":
+            label_image = rasterize_instance_label_image(particles)
+        else:
+            label_image = render_instance_label_image(particles)
+
+        if mask_format == "label":
+            output_utilities.write(
+                writer,
+                mask_utilities.save_label_image,
+                label_image,
+                instance_classes,
+                image_id,
+                absolute_output_directory,
+            )
+
+            return mask_utilities.get_label_file_paths(
+                absolute_output_directory, image_id
+            )
+
+        return mask_utilities.save_masks(
+            mask_utilities.get_instance_masks(label_image, len(particles)),
+            instance_classes,
+            image_id,
+            absolute_output_directory,
+            mask_format,
+            writer=writer,
+            output_format=output_format,
+        )
+
     # with TemporaryState():
     # Set render settings.
-    setup_workbench_renderer()
+    setup_workbench_renderer(output_format)
     bpy.context.scene.display.shading.color_type = "MATERIAL"
 
     material_white = create_diffuse_color_material(
@@ -219,21 +1049,244 @@ def render_occlusion_masks(particles, image_id, absolute_output_directory):
         if instance.type == "MESH":
             replace_material(instance, material_black)
 
+    masks = []
+    output_file_paths = []
+
     # Change texture of particles to white texture one by one and render them.
     for mask_id, particle in enumerate(particles):
         replace_material(particle, material_white)
 
-        assert "class" in particle, (
-            "You need to assign the class attribute of the particles before saving "
-            "annotations:\nExample: particle['class'] = 'test'"
+        if mask_format == "png":
+            output_filename = f"mask_{image_id}_{mask_id}.png"
+            output_file_path = (
+                absolute_output_directory / particle["class"] / output_filename
+            )
+            output_file_paths.append(
+                save_render(
+                    output_file_path, output_format, writer, is_mask=True
+                )
+            )
+        else:
+            masks.append(_render_mask_to_variable())
+
+        replace_material(particle, material_black)
+
+    if mask_format != "png":
+        width, height = _get_render_resolution()
+        output_file_paths = mask_utilities.save_masks(
+            masks,
+            instance_classes,
+            image_id,
+            absolute_output_directory,
+            mask_format,
+            writer=writer,
+            output_format=output_format,
+            image_shape=(height, width),
         )
 
-        output_filename = f"mask_{image_id}_{mask_id}.png"
-        output_file_path = (
-            absolute_output_directory / particle["class"] / output_filename
+    return output_file_paths
+
+
+# render: Render the masks with the Workbench renderer.
+# rasterize: Project the evaluated geometry through the camera and rasterize
+#     it with numpy. This needs no render engine, e.g. on headless servers,
+#     but does not anti-alias the edges of the masks.
+MASK_BACKENDS = ["render", "rasterize"]
+
+
+def _get_render_resolution():
+    scene = bpy.context.scene
+    scale = scene.render.resolution_percentage / 100
+    width = int(scene.render.resolution_x * scale)
+    height = int(scene.render.resolution_y * scale)
+    return width, height
+
+
+def _get_pixel_projection():
+    """Get the projection of global coordinates to pixels of the camera.
+
+    Returns a 4x4 matrix, which maps global coordinates to the pixel
+    coordinates x, y (image rows, top to bottom) and the depth, as well as
+    the number of pixels per unit of length.
+    """
+    scene = bpy.context.scene
+    camera = scene.camera
+
+    assert (
+        camera.data.type == "ORTHO"
+    ), "Only orthographic cameras can be rasterized."
+
+    width, height = _get_render_resolution()
+    max_size = max(width, height)
+    pixels_per_unit = max_size / camera.data.ortho_scale
+
+    camera_to_pixels = np.array(
+        [
+            [
+                pixels_per_unit,
+                0,
+                0,
+                width / 2 - camera.data.shift_x * max_size,
+            ],
+            [
+                0,
+                -pixels_per_unit,
+                0,
+                height / 2 + camera.data.shift_y * max_size,
+            ],
+            [0, 0, -1, 0],
+            [0, 0, 0, 1],
+        ]
+    )
+    world_to_camera = np.array(camera.matrix_world.inverted())
+
+    return camera_to_pixels @ world_to_camera, pixels_per_unit
+
+
+def _transform_points(points, matrix):
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _get_mesh_triangles(instance, depsgraph):
+    """Get the triangles of the evaluated mesh of an instance.
+
+    Returns an (N, 3, 3) array of the global coordinates of the corners of
+    N triangles.
+    """
+    instance_evaluated = instance.evaluated_get(depsgraph)
+    mesh = instance_evaluated.to_mesh()
+
+    try:
+        mesh.calc_loop_triangles()
+
+        vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", vertices)
+
+        vertex_ids = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("vertices", vertex_ids)
+    finally:
+        instance_evaluated.to_mesh_clear()
+
+    vertices = _transform_points(
+        vertices.reshape(-1, 3).astype(np.float64),
+        np.array(instance_evaluated.matrix_world),
+    )
+
+    return vertices[vertex_ids].reshape(-1, 3, 3)
+
+
+def _get_projected_triangles(instances):
+    """Get the triangles of each instance in pixel coordinates.
+
+    Hair strands are approximated by flat ribbons of the hair diameter,
+    which face the camera. The emitter of a hair instance is only included,
+    if it is rendered as well.
+    """
+    depsgraph = blender.particles.get_evaluated_depsgraph()
+    world_to_pixels, pixels_per_unit = _get_pixel_projection()
+
+    triangle_sets = []
+
+    for instance in instances:
+        if blender.particles.is_hair(instance):
+            settings = instance.particle_systems[0].settings
+            num_steps = 2 ** settings.display_step + 1
+
+            (vertices,) = blender.particles.get_hair_spline_vertices(
+                [instance]
+            )
+            strands = _transform_points(vertices, world_to_pixels).reshape(
+                -1, num_steps, 3
+            )
+            (diameter,) = blender.particles.get_hair_diameter([instance])
+            triangles = rasterization_utilities.get_strand_triangles(
+                strands, diameter * pixels_per_unit
+            )
+
+            if settings.use_render_emitter:
+                emitter_triangles = _transform_points(
+                    _get_mesh_triangles(instance, depsgraph), world_to_pixels
+                )
+                triangles = np.concatenate([triangles, emitter_triangles])
+        else:
+            triangles = _transform_points(
+                _get_mesh_triangles(instance, depsgraph), world_to_pixels
+            )
+
+        triangle_sets.append(triangles)
+
+    return triangle_sets
+
+
+def _get_occluders(particles):
+    """Get all rendered meshes, which are not part of particles."""
+    particle_pointers = {particle.as_pointer() for particle in particles}
+
+    return [
+        instance
+        for instance in bpy.data.objects
+        if instance.type == "MESH"
+        and not instance.hide_render
+        and instance.as_pointer() not in particle_pointers
+    ]
+
+
+def _concatenate_triangle_sets(triangle_sets, instance_ids):
+    """Concatenate triangle sets and label each triangle with the id of
+    its set."""
+    num_triangles = [len(triangles) for triangles in triangle_sets]
+
+    if not sum(num_triangles):
+        return np.empty((0, 3, 3)), np.empty(0, dtype=np.int64)
+
+    return (
+        np.concatenate(triangle_sets),
+        np.repeat(instance_ids, num_triangles),
+    )
+
+
+@profiling_utilities.profiled()
+def rasterize_instance_label_image(particles):
+    """Rasterize all particles and return a label image.
+
+    This is the equivalent of render_instance_label_image without a render
+    engine: The returned integer array holds the id (index in particles + 1)
+    of the visible particle for each pixel and 0 for the background. All
+    other rendered meshes occlude the particles.
+    """
+    particles = blender.particles.ensure_iterability(particles)
+    occluders = _get_occluders(particles)
+
+    triangles, triangle_labels = _concatenate_triangle_sets(
+        _get_projected_triangles(list(particles) + occluders),
+        np.concatenate(
+            [np.arange(1, len(particles) + 1), np.zeros(len(occluders))]
+        ).astype(np.int64),
+    )
+
+    return rasterization_utilities.rasterize_label_image(
+        triangles, triangle_labels, _get_render_resolution()
+    )
+
+
+@profiling_utilities.profiled()
+def rasterize_object_masks(particles):
+    """Rasterize a binary mask of each complete particle, ignoring
+    occlusions."""
+    particles = blender.particles.ensure_iterability(particles)
+
+    triangles, triangle_instance_ids = _concatenate_triangle_sets(
+        _get_projected_triangles(particles), np.arange(len(particles))
+    )
+
+    return list(
+        rasterization_utilities.rasterize_instance_masks(
+            triangles,
+            triangle_instance_ids,
+            len(particles),
+            _get_render_resolution(),
         )
-        render_to_file(output_file_path)
-        replace_material(particle, material_black)
+    )
 
 
 def get_space_boundaries(resolution):
@@ -251,71 +1304,168 @@ def get_space_boundaries(resolution):
     return lower_space_boundaries_xyz, upper_space_boundaries_xyz
 
 
+# per_spline_csv: One <image_id>_spline<spline_id>.csv with the columns x, y
+#     and width per spline.
+# csv, parquet, npz: One <image_id>_splines.<extension> per image with the
+#     columns spline_id, x, y and width.
+SPLINE_FILE_FORMATS = ["per_spline_csv", "csv", "parquet", "npz"]
+
+
+@profiling_utilities.profiled()
 def save_spline_data(
-    particles, output_folder_path, image_id_string, resolution
+    particles,
+    output_folder_path,
+    image_id_string,
+    resolution,
+    file_format="per_spline_csv",
+    writer=None,
 ):
+    """Save the keypoints and widths of the splines of particles.
+
+    The keypoints are gathered in the main thread. If an
+    output_utilities.OutputWriter is given, then the files are written in
+    the background.
+
+    Returns the paths of the (possibly not yet written) files.
+    """
+    assert (
+        file_format in SPLINE_FILE_FORMATS
+    ), f"Unknown spline file format: {file_format}"
+
     fiber_diameters, keypoint_sets = _gather_spline_data(particles)
 
     lower_space_boundaries_xyz, _ = get_space_boundaries(resolution)
     x_min, y_min, _ = lower_space_boundaries_xyz
     image_width, image_height = resolution
 
-    spline_id_offset = 0
+    spline_data = _prepare_spline_data_for_saving(
+        keypoint_sets,
+        fiber_diameters,
+        image_width,
+        image_height,
+        x_min,
+        y_min,
+    )
 
-    for spline_id, (keypoints, fiber_diameter) in enumerate(
-        zip(keypoint_sets, fiber_diameters)
-    ):
-        spline_data = _prepare_spline_data_for_saving(
-            keypoints, fiber_diameter, image_width, image_height, x_min, y_min
+    if file_format == "per_spline_csv":
+        spline_indices = _split_spline_data(spline_data)
+        spline_file_paths = [
+            os.path.join(
+                output_folder_path,
+                f"{image_id_string}_spline{spline_id:06d}.csv",
+            )
+            for spline_id in range(len(spline_indices))
+        ]
+        output_utilities.write(
+            writer,
+            _write_spline_data_to_files,
+            spline_data,
+            spline_indices,
+            spline_file_paths,
         )
 
-        if spline_data.empty:
-            spline_id_offset -= 1
-            continue
+        return spline_file_paths
 
-        spline_id += spline_id_offset
+    spline_file_path = os.path.join(
+        output_folder_path, f"{image_id_string}_splines.{file_format}"
+    )
+    output_utilities.write(
+        writer,
+        _write_spline_data_to_file,
+        spline_data,
+        spline_file_path,
+        file_format,
+    )
+
+    return [spline_file_path]
 
-        _write_spline_data_to_file(
-            spline_data, output_folder_path, image_id_string, spline_id
-        )
 
+def _split_spline_data(spline_data):
+    """Return the indices of the keypoints of each spline."""
+    spline_ids = spline_data["spline_id"]
 
-def _write_spline_data_to_file(
-    spline_data, output_folder_path, image_id_string, spline_id
+    if not len(spline_ids):
+        return []
+
+    split_indices = np.flatnonzero(np.diff(spline_ids)) + 1
+
+    return np.split(np.arange(len(spline_ids)), split_indices)
+
+
+def _write_spline_data_to_files(
+    spline_data, spline_indices, spline_file_paths
 ):
-    spline_file_name = f"{image_id_string}_spline{spline_id:06d}.csv"
-    spline_file_path = os.path.join(output_folder_path, spline_file_name)
-    spline_data.to_csv(spline_file_path, index=False)
+    for indices, spline_file_path in zip(spline_indices, spline_file_paths):
+        single_spline_data = pd.DataFrame(
+            {
+                column: spline_data[column][indices]
+                for column in ["x", "y", "width"]
+            }
+        )
+
+        with output_utilities.atomic_file_path(
+            spline_file_path
+        ) as temporary_file_path:
+            single_spline_data.to_csv(temporary_file_path, index=False)
+
+
+def _write_spline_data_to_file(spline_data, spline_file_path, file_format):
+    with output_utilities.atomic_file_path(
+        spline_file_path
+    ) as temporary_file_path:
+        if file_format == "npz":
+            np.savez(temporary_file_path, **spline_data)
+        elif file_format == "parquet":
+            pd.DataFrame(spline_data).to_parquet(
+                temporary_file_path, index=False
+            )
+        else:
+            pd.DataFrame(spline_data).to_csv(temporary_file_path, index=False)
 
 
 def _prepare_spline_data_for_saving(
-    keypoints, fiber_diameter, image_width, image_height, x_min, y_min
+    keypoint_sets, fiber_diameters, image_width, image_height, x_min, y_min
 ):
-    keypoints_x, keypoints_y = _separate_keypoint_coordinates(keypoints)
-    keypoints_x, keypoints_y = _offset_keypoints(
-        keypoints_x, keypoints_y, x_min, y_min
-    )
-    keypoints_y = _horizontally_mirror_keypoints(keypoints_y, image_height)
-    spline_data = pd.DataFrame(
-        {"x": keypoints_x, "y": keypoints_y, "width": fiber_diameter}
-    )
-    spline_data = _filter_keypoints_outside_of_image(
-        spline_data, image_height, image_width
-    )
+    """Transform the keypoints of all splines to image coordinates at once.
+
+    Returns a dict of the columns spline_id, x, y and width. Keypoints
+    outside of the image are removed and the splines, which are left
+    without keypoints, are skipped when numbering them.
+    """
+    num_keypoints = [len(keypoints) for keypoints in keypoint_sets]
+
+    if sum(num_keypoints):
+        keypoints = np.concatenate(
+            [np.reshape(keypoints, (-1, 2)) for keypoints in keypoint_sets]
+        )
+    else:
+        keypoints = np.empty((0, 2))
 
-    return spline_data
+    spline_ids = np.repeat(np.arange(len(keypoint_sets)), num_keypoints)
+    widths = np.repeat(np.asarray(fiber_diameters, dtype=float), num_keypoints)
 
+    keypoints = _offset_keypoints(keypoints, x_min, y_min)
+    keypoints = _horizontally_mirror_keypoints(keypoints, image_height)
 
-def _offset_keypoints(keypoints_x, keypoints_y, x_min, y_min):
-    keypoints_x = [keypoint_x - x_min for keypoint_x in keypoints_x]
-    keypoints_y = [keypoint_y - y_min for keypoint_y in keypoints_y]
-    return keypoints_x, keypoints_y
+    is_inside = _get_keypoints_inside_of_image(
+        keypoints, image_height, image_width
+    )
+    keypoints = keypoints[is_inside]
+    widths = widths[is_inside]
+
+    # Number the remaining splines consecutively.
+    _, spline_ids = np.unique(spline_ids[is_inside], return_inverse=True)
 
+    return {
+        "spline_id": spline_ids,
+        "x": keypoints[:, 0],
+        "y": keypoints[:, 1],
+        "width": widths,
+    }
 
-def _separate_keypoint_coordinates(keypoints):
-    keypoints_x = [keypoint[0] for keypoint in keypoints]
-    keypoints_y = [keypoint[1] for keypoint in keypoints]
-    return keypoints_x, keypoints_y
+
+def _offset_keypoints(keypoints, x_min, y_min):
+    return keypoints - (x_min, y_min)
 
 
 def _gather_spline_data(particles):
@@ -324,14 +1474,14 @@ def _gather_spline_data(particles):
     return fiber_diameters, keypoint_sets
 
 
-def _filter_keypoints_outside_of_image(spline_data, height, width):
-    spline_data = spline_data.query(
-        f"x>=0 and x<={width} and y>=0 and y<={height}"
-    )
-    return spline_data
+def _get_keypoints_inside_of_image(keypoints, height, width):
+    x = keypoints[:, 0]
+    y = keypoints[:, 1]
+    return (x >= 0) & (x <= width) & (y >= 0) & (y <= height)
 
 
-def _horizontally_mirror_keypoints(keypoints_y, height):
+def _horizontally_mirror_keypoints(keypoints, height):
     # flip y-axis (in blender the y-axis is oriented in the up-direction of the image)
-    keypoints_y = [height - keypoint_y for keypoint_y in keypoints_y]
-    return keypoints_y
+    keypoints = keypoints.copy()
+    keypoints[:, 1] = height - keypoints[:, 1]
+    return keypoints
@@ -1,19 +1,179 @@
+import contextlib
+import sys
+from collections import defaultdict
+
 import bpy
 
+import profiling_utilities
+
+# Datablock collections of bpy.data, which are created by recipes and
+# therefore have to be tracked to reset scenes.
+DATA_COLLECTION_NAMES = [
+    "objects",
+    "meshes",
+    "particles",
+    "materials",
+    "textures",
+    "images",
+    "curves",
+    "collections",
+]
+
+
+# Collections of bpy.data, which purge_unused_data(full=True) walks.
+PURGE_COLLECTION_NAMES = ["meshes", "materials", "textures", "images"]
+
+# Names of the datablocks, which were registered with track_datablocks, per
+# collection of bpy.data. Names are stored instead of references, since
+# references to removed datablocks are not always invalidated.
+_tracked_datablock_names = defaultdict(set)
+
+_purge_deferral_depth = 0
+_is_purge_pending = False
+
+
+def track_datablocks(datablocks, collection_name):
+    """Register datablocks of a collection of bpy.data (e.g. "meshes"), so
+    that purge_unused_data removes them, once they are unused.
+    """
+    names = _tracked_datablock_names[collection_name]
+
+    for datablock in datablocks:
+        names.add(datablock.name)
+
+
+def _get_unused_tracked_datablocks():
+    unused_datablocks = []
+
+    for collection_name, names in _tracked_datablock_names.items():
+        collection = getattr(bpy.data, collection_name)
+
+        for name in list(names):
+            datablock = collection.get(name)
+
+            if datablock is None:
+                names.discard(name)
+            elif not datablock.users:
+                unused_datablocks.append(datablock)
+                names.discard(name)
+
+    return unused_datablocks
+
+
+def _get_unused_datablocks():
+    return [
+        datablock
+        for collection_name in PURGE_COLLECTION_NAMES
+        for datablock in getattr(bpy.data, collection_name)
+        if not datablock.users
+    ]
+
+
+def purge_unused_data(full=False):
+    """Remove datablocks without users and return their number.
+
+    By default, only the datablocks registered with track_datablocks are
+    visited, so that the cost does not grow with the size of the scene.
+    full=True visits all datablocks of PURGE_COLLECTION_NAMES. Within
+    deferred_purge, the purge is postponed to the end of the block.
+    """
+    global _is_purge_pending
+
+    if _purge_deferral_depth:
+        _is_purge_pending = True
+        return 0
+
+    num_removed_datablocks = 0
+
+    # Removing an object can leave its data unused, so repeat until nothing
+    # is left to remove.
+    while True:
+        if full:
+            unused_datablocks = _get_unused_datablocks()
+        else:
+            unused_datablocks = _get_unused_tracked_datablocks()
+
+        if not unused_datablocks:
+            return num_removed_datablocks
+
+        bpy.data.batch_remove(unused_datablocks)
+        num_removed_datablocks += len(unused_datablocks)
+
+
+@contextlib.contextmanager
+def deferred_purge():
+    """Postpone all calls of purge_unused_data within the block to a single
+    purge at its end, e.g. to clean up once per image instead of once per
+    deletion.
+    """
+    global _purge_deferral_depth, _is_purge_pending
+
+    _purge_deferral_depth += 1
+
+    try:
+        yield
+    finally:
+        _purge_deferral_depth -= 1
+
+        if not _purge_deferral_depth and _is_purge_pending:
+            _is_purge_pending = False
+            purge_unused_data()
+
+
+def get_datablock_pointers(collection_names=None):
+    if collection_names is None:
+        collection_names = DATA_COLLECTION_NAMES
+
+    return {
+        collection_name: {
+            datablock.as_pointer()
+            for datablock in getattr(bpy.data, collection_name)
+        }
+        for collection_name in collection_names
+    }
+
+
+def get_new_datablocks(datablock_pointers):
+    new_datablocks = []
+
+    for collection_name, pointers in datablock_pointers.items():
+        new_datablocks += [
+            datablock
+            for datablock in getattr(bpy.data, collection_name)
+            if datablock.as_pointer() not in pointers
+        ]
+
+    return new_datablocks
+
+
+def count_operator_calls():
+    """Count every call of a bpy.ops operator with the global profiler of
+    profiling_utilities, as "operator_calls" and per operator as
+    "operator_calls/<module>.<operator>".
+
+    Returns False, if the operator class of this Blender version is unknown.
+    """
+    operators_module = sys.modules.get("bpy.ops")
+    operator_class = getattr(
+        operators_module, "BPyOpsSubModOp", None
+    ) or getattr(operators_module, "_BPyOpsSubModOp", None)
+
+    if operator_class is None:
+        return False
+
+    call = operator_class.__call__
 
-def purge_unused_data():
-    for data in bpy.data.meshes:
-        if not data.users:
-            bpy.data.meshes.remove(data)
+    if getattr(call, "is_counting", False):
+        return True
 
-    for data in bpy.data.materials:
-        if not data.users:
-            bpy.data.materials.remove(data)
+    def counting_call(self, *args, **kwargs):
+        profiling_utilities.count("operator_calls")
+        profiling_utilities.count(
+            f"operator_calls/{self._module}.{self._func}"
+        )
+        return call(self, *args, **kwargs)
 
-    for data in bpy.data.textures:
-        if not data.users:
-            bpy.data.textures.remove(data)
+    counting_call.is_counting = True
+    operator_class.__call__ = counting_call
 
-    for data in bpy.data.images:
-        if not data.users:
-            bpy.data.images.remove(data)
+    return True
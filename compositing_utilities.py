@@ -0,0 +1,431 @@
+import functools
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from recipe_utilities import get_random_generator
+
+# Layers are float32 arrays of shape (height, width, 2), which hold the gray
+# value and the alpha value of each pixel in the range [0, 1]. Since all
+# compositing operations treat the color channels alike, compositing the
+# luminance is equivalent to compositing RGB images and converting the
+# result to grayscale.
+GRAY = 0
+ALPHA = 1
+
+
+def _cubic_kernel(x, a=-0.5):
+    # Same kernel as the bicubic filter of PIL.
+    x = np.abs(x)
+    return np.where(
+        x < 1,
+        ((a + 2) * x - (a + 3)) * x * x + 1,
+        np.where(x < 2, (((x - 5) * x + 8) * x - 4) * a, 0),
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def _get_resize_matrix(source_size, target_size):
+    """Get the matrix, which resizes a vector like PIL's bicubic filter."""
+    scale = source_size / target_size
+    filter_scale = max(scale, 1)
+
+    centers = (np.arange(target_size) + 0.5) * scale
+    distances = (
+        np.arange(source_size)[np.newaxis, :] + 0.5 - centers[:, np.newaxis]
+    ) / filter_scale
+
+    weights = _cubic_kernel(distances)
+    weights /= np.sum(weights, axis=1, keepdims=True)
+
+    return weights.astype(np.float32)
+
+
+def resize_bicubic(array, target_size, out=None):
+    """Resize a 2D array to target_size (width, height)."""
+    width, height = target_size
+    source_height, source_width = array.shape
+
+    if (source_width, source_height) == (width, height):
+        if out is None:
+            return array.astype(np.float32)
+
+        out[...] = array
+        return out
+
+    resize_matrix_y = _get_resize_matrix(source_height, height)
+    resize_matrix_x = _get_resize_matrix(source_width, width)
+
+    return np.matmul(
+        resize_matrix_y @ array.astype(np.float32), resize_matrix_x.T, out=out
+    )
+
+
+def _get_base_noise(image_size, scale, strength, distribution, rng):
+    width, height = image_size
+
+    height_base = math.ceil(height / scale)
+    width_base = math.ceil(width / scale)
+    shape = (height_base, width_base)
+
+    if distribution == "gaussian":
+        return rng.standard_normal(shape, dtype=np.float32) * strength + 0.5
+    elif distribution == "uniform":
+        return rng.random(shape, dtype=np.float32)
+
+    raise ValueError(f"Unknown noise distribution: {distribution}")
+
+
+def generate_noise_layer(
+    image_size,
+    scale=1,
+    strength=1,
+    contrast=1,
+    brightness=1,
+    distribution="gaussian",
+    rng=None,
+    out=None,
+):
+    """NumPy version of recipe_utilities.generate_gaussian_noise_image and
+    generate_uniform_noise_image, which returns a layer.
+    """
+    rng = get_random_generator(rng)
+
+    width, height = image_size
+
+    if out is None:
+        out = np.empty((height, width, 2), dtype=np.float32)
+
+    noise_base = _get_base_noise(
+        image_size, scale, strength, distribution, rng
+    )
+
+    gray = out[..., GRAY]
+    alpha = out[..., ALPHA]
+
+    resize_bicubic(noise_base, image_size, out=gray)
+    np.clip(gray, 0, 1, out=gray)
+    alpha.fill(1)
+
+    adjust_brightness(out, brightness, out=out)
+    adjust_contrast(out, contrast, out=out)
+
+    return out
+
+
+def adjust_brightness(layer, factor, out=None):
+    """Like PIL.ImageEnhance.Brightness, which keeps the alpha channel."""
+    if out is None:
+        out = layer.copy()
+    elif out is not layer:
+        out[...] = layer
+
+    gray = out[..., GRAY]
+    np.multiply(gray, factor, out=gray)
+    np.clip(gray, 0, 1, out=gray)
+
+    return out
+
+
+def adjust_contrast(layer, factor, out=None):
+    """Like PIL.ImageEnhance.Contrast, which blends with the (rounded) mean
+    gray value and keeps the alpha channel.
+    """
+    if out is None:
+        out = layer.copy()
+    elif out is not layer:
+        out[...] = layer
+
+    gray = out[..., GRAY]
+    mean = np.round(np.mean(gray) * 255) / 255
+    np.multiply(gray, factor, out=gray)
+    gray += mean * (1 - factor)
+    np.clip(gray, 0, 1, out=gray)
+
+    return out
+
+
+def blend(layer_a, layer_b, factor, out=None):
+    """Like PIL.Image.blend: (1 - factor) * layer_a + factor * layer_b"""
+    out = np.multiply(layer_b, factor, out=out)
+    out += np.multiply(layer_a, 1 - factor, dtype=np.float32)
+    return np.clip(out, 0, 1, out=out)
+
+
+def alpha_composite(layer_destination, layer_source, out=None):
+    """Like PIL.Image.alpha_composite: Draw layer_source over
+    layer_destination.
+    """
+    alpha_source = layer_source[..., ALPHA]
+    alpha_destination = layer_destination[..., ALPHA] * (1 - alpha_source)
+    alpha_out = alpha_source + alpha_destination
+
+    gray_out = (
+        layer_source[..., GRAY] * alpha_source
+        + layer_destination[..., GRAY] * alpha_destination
+    )
+    np.divide(gray_out, alpha_out, out=gray_out, where=alpha_out > 0)
+    gray_out[alpha_out == 0] = 0
+
+    if out is None:
+        out = np.empty(layer_destination.shape, dtype=np.float32)
+
+    out[..., GRAY] = gray_out
+    out[..., ALPHA] = alpha_out
+
+    return out
+
+
+def gaussian_blur(layer, sigma, out=None):
+    """Similar to PIL.ImageFilter.GaussianBlur, applied to gray and alpha."""
+    if out is None:
+        out = np.empty(layer.shape, dtype=np.float32)
+
+    for channel in (GRAY, ALPHA):
+        ndimage.gaussian_filter(
+            layer[..., channel], sigma, output=out[..., channel]
+        )
+
+    return out
+
+
+def image_to_layer(image, out=None):
+    """Convert a PIL image or an RGB(A) uint8 array to a layer."""
+    image = np.asarray(image)
+
+    if out is None:
+        out = np.empty(image.shape[:2] + (2,), dtype=np.float32)
+
+    if image.ndim == 2:
+        out[..., GRAY] = image / 255
+        out[..., ALPHA] = 1
+        return out
+
+    # Luminance weights of PIL.
+    out[..., GRAY] = (
+        image[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    ) / 255
+
+    if image.shape[2] == 4:
+        out[..., ALPHA] = image[..., 3] / 255
+    else:
+        out[..., ALPHA] = 1
+
+    return out
+
+
+def layer_to_array(layer, dtype=np.uint8):
+    """Get the gray values of a layer, either as float in [0, 1] or as
+    uint8 in [0, 255]. Like the 8 bit conversions of PIL, the latter are
+    truncated, not rounded.
+    """
+    gray = layer[..., GRAY]
+
+    if np.issubdtype(dtype, np.floating):
+        return gray.astype(dtype)
+
+    return np.floor(gray * 255).astype(dtype)
+
+
+class LayerCompositor:
+    """Generates and composes layers of a fixed resolution.
+
+    All layers are written to buffers, which are allocated once and reused
+    for every image. Therefore, the returned layers are only valid until the
+    next call with the same layer name.
+    """
+
+    def __init__(self, image_size):
+        self.image_size = tuple(image_size)
+        self.buffers = dict()
+
+    def get_buffer(self, name):
+        width, height = self.image_size
+
+        if name not in self.buffers:
+            self.buffers[name] = np.empty((height, width, 2), dtype=np.float32)
+
+        return self.buffers[name]
+
+    def noise_layer(self, name, **kwargs):
+        return generate_noise_layer(
+            self.image_size, out=self.get_buffer(name), **kwargs
+        )
+
+    def bank_layer(self, name, noise_bank, rng=None):
+        return noise_bank.draw(rng=rng, out=self.get_buffer(name))
+
+    def image_layer(self, name, image):
+        return image_to_layer(image, out=self.get_buffer(name))
+
+    def compose(self, base_layer, operations, name="composite"):
+        """Compose layers in a single pass over the operations.
+
+        operations is a sequence of ("blend", layer, factor) and
+        ("alpha_composite", layer) tuples, which are applied to base_layer in
+        order.
+        """
+        composite = self.get_buffer(name)
+        composite[...] = base_layer
+
+        for operation, layer, *arguments in operations:
+            if operation == "blend":
+                blend(composite, layer, *arguments, out=composite)
+            elif operation == "alpha_composite":
+                alpha_composite(composite, layer, out=composite)
+            else:
+                raise ValueError(f"Unknown operation: {operation}")
+
+        return composite
+
+
+class NoiseBank:
+    """A bank of pre-generated noise layers, stored as memory-mapped .npy
+    file.
+
+    The bank holds num_layers square uint8 layers, which are large enough
+    to crop an image of image_size in any orientation. Every drawn layer is
+    a random crop of a random layer, which is randomly flipped and rotated
+    by multiples of 90 degrees. This replaces the synthesis of statistically
+    interchangeable noise layers by a cheap read.
+
+    The file is keyed by a hash of the generation parameters, which are
+    additionally stored next to it as .json file and validated on load. If
+    the file is missing or invalid, then the bank is regenerated.
+    """
+
+    def __init__(
+        self,
+        directory,
+        image_size,
+        num_layers=32,
+        scale=1,
+        strength=1,
+        contrast=1,
+        brightness=1,
+        distribution="gaussian",
+        seed=0,
+    ):
+        self.image_size = tuple(image_size)
+        self.layer_size = max(self.image_size)
+
+        self.parameters = {
+            "layer_size": self.layer_size,
+            "num_layers": num_layers,
+            "scale": scale,
+            "strength": strength,
+            "contrast": contrast,
+            "brightness": brightness,
+            "distribution": distribution,
+            "seed": seed,
+        }
+
+        key = hashlib.sha1(
+            json.dumps(self.parameters, sort_keys=True).encode()
+        ).hexdigest()[:16]
+        self.file_path = os.path.join(directory, f"noise_bank_{key}.npy")
+
+        if not self._is_valid():
+            self._generate()
+
+        self.layers = np.load(self.file_path, mmap_mode="r")
+
+    @property
+    def parameter_file_path(self):
+        return os.path.splitext(self.file_path)[0] + ".json"
+
+    @property
+    def expected_shape(self):
+        return (
+            self.parameters["num_layers"],
+            self.layer_size,
+            self.layer_size,
+        )
+
+    def _is_valid(self):
+        try:
+            with open(self.parameter_file_path) as parameter_file:
+                parameters = json.load(parameter_file)
+
+            layers = np.load(self.file_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return False
+
+        return (
+            parameters == self.parameters
+            and layers.shape == self.expected_shape
+            and layers.dtype == np.uint8
+        )
+
+    def _generate(self):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+
+        rng = np.random.default_rng(self.parameters["seed"])
+        layer_size = (self.layer_size, self.layer_size)
+        buffer = np.empty(layer_size[::-1] + (2,), dtype=np.float32)
+
+        # Write to a temporary file first, so that other processes never see
+        # an incomplete bank.
+        temporary_file_path = self.file_path + f".{os.getpid()}.tmp"
+        layers = np.lib.format.open_memmap(
+            temporary_file_path,
+            mode="w+",
+            dtype=np.uint8,
+            shape=self.expected_shape,
+        )
+
+        for layer_id in range(self.parameters["num_layers"]):
+            generate_noise_layer(
+                layer_size,
+                scale=self.parameters["scale"],
+                strength=self.parameters["strength"],
+                contrast=self.parameters["contrast"],
+                brightness=self.parameters["brightness"],
+                distribution=self.parameters["distribution"],
+                rng=rng,
+                out=buffer,
+            )
+            layers[layer_id] = layer_to_array(buffer, dtype=np.uint8)
+
+        layers.flush()
+        del layers
+        os.replace(temporary_file_path, self.file_path)
+
+        temporary_file_path = self.parameter_file_path + f".{os.getpid()}.tmp"
+        with open(temporary_file_path, "w") as parameter_file:
+            json.dump(self.parameters, parameter_file, indent=2)
+        os.replace(temporary_file_path, self.parameter_file_path)
+
+    def draw(self, rng=None, out=None):
+        """Draw a random layer of image_size from the bank."""
+        rng = get_random_generator(rng)
+
+        width, height = self.image_size
+
+        if out is None:
+            out = np.empty((height, width, 2), dtype=np.float32)
+
+        layer = self.layers[rng.integers(len(self.layers))]
+        layer = np.rot90(layer, k=rng.integers(4))
+
+        if rng.random() < 0.5:
+            layer = layer[:, ::-1]
+
+        y = rng.integers(self.layer_size - height + 1)
+        x = rng.integers(self.layer_size - width + 1)
+        layer = layer[y : y + height, x : x + width]
+
+        np.multiply(layer, np.float32(1 / 255), out=out[..., GRAY])
+        out[..., ALPHA] = 1
+
+        return out
+
+
+@functools.lru_cache(maxsize=8)
+def get_layer_compositor(image_size):
+    """Get a LayerCompositor, which is shared by all images of a size."""
+    return LayerCompositor(image_size)
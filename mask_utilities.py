@@ -0,0 +1,418 @@
+#!/usr/bin/python
+
+import getopt
+import json
+import os
+import re
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+from output_utilities import DEFAULT_OUTPUT_FORMATS, atomic_file_path, write
+
+MAX_NUM_INSTANCES = 2 ** 24 - 1
+MAX_NUM_INSTANCES_LABEL_PNG = 2 ** 16 - 1
+
+# png: One binary image per mask: <class>/mask_<image_id>_<mask_id>.png (the
+#     file format can be changed via an output_utilities.OutputFormat)
+# coco: All masks of an image as run-length encoded, COCO-style annotations:
+#     masks_<image_id>.json
+# label: A 16 bit instance label PNG (0 = background, i + 1 = mask i) and a
+#     class table: masks_<image_id>.png and masks_<image_id>_classes.csv
+MASK_FORMATS = ["png", "coco", "label"]
+
+
+def encode_instance_ids_as_colors(instance_ids):
+    """Encode instance ids as unique 8 bit RGB colors in the range [0, 1].
+
+    The id 0 is reserved for the background.
+    """
+    instance_ids = np.asarray(instance_ids, dtype=np.int64)
+
+    assert np.all(instance_ids > 0), "Instance ids must be positive."
+    assert np.all(
+        instance_ids <= MAX_NUM_INSTANCES
+    ), f"Instance ids must not exceed {MAX_NUM_INSTANCES}."
+
+    red = (instance_ids >> 16) & 255
+    green = (instance_ids >> 8) & 255
+    blue = instance_ids & 255
+
+    return np.stack([red, green, blue], axis=-1) / 255
+
+
+def decode_instance_label_image(image_rgb):
+    """Decode an 8 bit RGB image of encoded instance ids to a label image."""
+    image_rgb = np.asarray(image_rgb).astype(np.int32)
+    red, green, blue = (image_rgb[..., channel] for channel in range(3))
+
+    return (red << 16) | (green << 8) | blue
+
+
+def get_instance_masks(label_image, num_instances):
+    """Yield a binary mask for each of the instance ids 1...num_instances.
+
+    Instances that are not visible yield empty masks.
+    """
+    slices = ndimage.find_objects(label_image, max_label=num_instances)
+
+    for instance_id, instance_slice in enumerate(slices, start=1):
+        mask = np.zeros(label_image.shape, dtype=bool)
+
+        if instance_slice is not None:
+            mask[instance_slice] = label_image[instance_slice] == instance_id
+
+        yield mask
+
+
+def get_class_map(label_image, instance_classes, class_names=None):
+    """Map a label image to class indices (0 = background).
+
+    The class of instance i + 1 is instance_classes[i]. The class index of
+    class c is class_names.index(c) + 1.
+    """
+    if class_names is None:
+        class_names = sorted(set(instance_classes))
+
+    lookup_table = np.zeros(len(instance_classes) + 1, dtype=np.uint16)
+    lookup_table[1:] = [
+        class_names.index(instance_class) + 1
+        for instance_class in instance_classes
+    ]
+
+    label_image = np.where(label_image < len(lookup_table), label_image, 0)
+
+    return lookup_table[label_image]
+
+
+def save_mask(mask, file_path, output_format=None):
+    """Save a binary mask in the output_utilities.OutputFormat output_format
+    (default: output_utilities.DEFAULT_OUTPUT_FORMATS["mask"]), which
+    determines the extension of the saved file.
+    """
+    if output_format is None:
+        output_format = DEFAULT_OUTPUT_FORMATS["mask"]
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    output_format.save(np.asarray(mask, dtype=bool), file_path)
+
+
+def encode_rle(mask):
+    """Run-length encode a binary mask in the (uncompressed) COCO format.
+
+    The pixels are traversed in column-major order and the counts start
+    with the length of the first run of zeros.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    pixels = mask.ravel(order="F")
+
+    change_indices = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    run_boundaries = np.concatenate([[0], change_indices, [pixels.size]])
+    counts = np.diff(run_boundaries)
+
+    if pixels.size and pixels[0]:
+        counts = np.concatenate([[0], counts])
+
+    return {"size": list(mask.shape), "counts": counts.tolist()}
+
+
+def decode_rle(rle):
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    pixels = np.repeat(values, counts)
+
+    return pixels.reshape((height, width), order="F")
+
+
+def get_bounding_box(mask):
+    """Return the COCO-style bounding box [x, y, width, height] of a mask."""
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    columns = np.flatnonzero(np.any(mask, axis=0))
+
+    if not rows.size:
+        return [0, 0, 0, 0]
+
+    return [
+        int(columns[0]),
+        int(rows[0]),
+        int(columns[-1] - columns[0] + 1),
+        int(rows[-1] - rows[0] + 1),
+    ]
+
+
+def save_masks(
+    masks,
+    instance_classes,
+    image_id,
+    output_directory,
+    mask_format="png",
+    class_names=None,
+    writer=None,
+    output_format=None,
+    image_shape=None,
+):
+    """Save the masks of an image in one of the MASK_FORMATS.
+
+    masks is an iterable of binary masks and instance_classes holds the
+    class of each mask. The "png" format saves one file per mask in the
+    output_utilities.OutputFormat output_format. The "label" format needs
+    the (height, width) image_shape to save an empty label image, if there
+    are no masks. Otherwise, nothing is saved. If an
+    output_utilities.OutputWriter is given, then the files are written in
+    the background.
+
+    Returns the paths of the (possibly not yet written) files.
+    """
+    assert mask_format in MASK_FORMATS, f"Unknown mask format: {mask_format}"
+
+    if output_format is None:
+        output_format = DEFAULT_OUTPUT_FORMATS["mask"]
+
+    output_directory = Path(output_directory)
+
+    if mask_format == "png":
+        output_file_paths = []
+
+        for mask_id, (mask, instance_class) in enumerate(
+            zip(masks, instance_classes)
+        ):
+            output_file_path = output_format.get_file_path(
+                output_directory
+                / instance_class
+                / f"mask_{image_id}_{mask_id}.png"
+            )
+            write(writer, save_mask, mask, output_file_path, output_format)
+            output_file_paths.append(output_file_path)
+
+        return output_file_paths
+    elif mask_format == "coco":
+        write(
+            writer,
+            save_coco_annotations,
+            list(masks),
+            instance_classes,
+            image_id,
+            output_directory,
+            class_names,
+        )
+
+        return [get_coco_file_path(output_directory, image_id)]
+    elif mask_format == "label":
+        label_image = None
+
+        if image_shape is not None:
+            label_image = np.zeros(image_shape, dtype=np.int64)
+
+        for mask_id, mask in enumerate(masks):
+            if label_image is None:
+                label_image = np.zeros(mask.shape, dtype=np.int64)
+
+            if np.any(label_image[mask]):
+                raise ValueError(
+                    "The label format requires non-overlapping masks."
+                )
+
+            label_image[mask] = mask_id + 1
+
+        if label_image is None:
+            return []
+
+        write(
+            writer,
+            save_label_image,
+            label_image,
+            instance_classes,
+            image_id,
+            output_directory,
+        )
+
+        return get_label_file_paths(output_directory, image_id)
+
+
+def get_coco_file_path(output_directory, image_id):
+    return str(Path(output_directory) / f"masks_{image_id}.json")
+
+
+def get_label_file_paths(output_directory, image_id):
+    """Return the paths of the label image and of the class table."""
+    output_directory = Path(output_directory)
+
+    return [
+        str(output_directory / f"masks_{image_id}.png"),
+        str(output_directory / f"masks_{image_id}_classes.csv"),
+    ]
+
+
+def save_coco_annotations(
+    masks, instance_classes, image_id, output_directory, class_names=None
+):
+    """Save masks as run-length encoded, COCO-style annotations.
+
+    Masks that are empty (e.g. completely occluded particles) are skipped,
+    the annotation id is the index of the mask.
+    """
+    if class_names is None:
+        class_names = sorted(set(instance_classes))
+
+    annotations = []
+    height, width = None, None
+
+    for mask_id, (mask, instance_class) in enumerate(
+        zip(masks, instance_classes)
+    ):
+        height, width = mask.shape
+        area = int(np.count_nonzero(mask))
+
+        if not area:
+            continue
+
+        annotations.append(
+            {
+                "id": mask_id,
+                "image_id": image_id,
+                "category_id": class_names.index(instance_class) + 1,
+                "segmentation": encode_rle(mask),
+                "area": area,
+                "bbox": get_bounding_box(mask),
+                "iscrowd": 0,
+            }
+        )
+
+    coco_data = {
+        "images": [{"id": image_id, "height": height, "width": width}],
+        "categories": [
+            {"id": class_id, "name": class_name}
+            for class_id, class_name in enumerate(class_names, start=1)
+        ],
+        "annotations": annotations,
+    }
+
+    output_file_path = get_coco_file_path(output_directory, image_id)
+    os.makedirs(output_directory, exist_ok=True)
+
+    with atomic_file_path(output_file_path) as temporary_file_path:
+        with open(temporary_file_path, "w") as file:
+            json.dump(coco_data, file)
+
+
+def save_label_image(
+    label_image, instance_classes, image_id, output_directory
+):
+    """Save a 16 bit instance label PNG and a table of the instance classes."""
+    assert (
+        len(instance_classes) <= MAX_NUM_INSTANCES_LABEL_PNG
+    ), "Too many instances for a 16 bit label image."
+
+    os.makedirs(output_directory, exist_ok=True)
+    label_file_path, class_file_path = get_label_file_paths(
+        output_directory, image_id
+    )
+
+    label_image = np.where(
+        label_image <= len(instance_classes), label_image, 0
+    )
+
+    with atomic_file_path(label_file_path) as temporary_file_path:
+        Image.fromarray(label_image.astype(np.uint16)).save(
+            temporary_file_path
+        )
+
+    with atomic_file_path(class_file_path) as temporary_file_path:
+        with open(temporary_file_path, "w") as file:
+            file.write("instance_id,class\n")
+
+            for instance_id, instance_class in enumerate(
+                instance_classes, start=1
+            ):
+                file.write(f"{instance_id},{instance_class}\n")
+
+
+def _find_mask_files(directory):
+    mask_file_pattern = re.compile(r"mask_(.+)_(\d+)\.png")
+
+    mask_files = defaultdict(list)
+
+    for mask_file_path in Path(directory).glob("*/mask_*_*.png"):
+        match = mask_file_pattern.fullmatch(mask_file_path.name)
+
+        if match is None:
+            continue
+
+        image_id, mask_id = match.groups()
+        mask_files[image_id].append((int(mask_id), mask_file_path))
+
+    for image_id in mask_files:
+        mask_files[image_id].sort()
+
+    return mask_files
+
+
+def convert_mask_files(directory, mask_format, remove_originals=False):
+    """Convert a dataset of per-mask PNGs to another of the MASK_FORMATS."""
+    assert mask_format in MASK_FORMATS, f"Unknown mask format: {mask_format}"
+
+    if mask_format == "png":
+        return
+
+    for image_id, mask_files in _find_mask_files(directory).items():
+        instance_classes = [
+            mask_file_path.parent.name for _, mask_file_path in mask_files
+        ]
+        masks = (
+            np.asarray(Image.open(mask_file_path).convert("L")) > 127
+            for _, mask_file_path in mask_files
+        )
+
+        save_masks(masks, instance_classes, image_id, directory, mask_format)
+
+        if remove_originals:
+            for _, mask_file_path in mask_files:
+                os.remove(mask_file_path)
+
+
+def print_help():
+    print("Usage:")
+    print("mask_utilities.py -d <datasetfolder> -f <coco|label> [--remove]")
+    sys.exit(2)
+
+
+def main(argv):
+    directory = None
+    mask_format = None
+    remove_originals = False
+
+    try:
+        opts, args = getopt.getopt(
+            argv, "hd:f:", ["help", "directory=", "format=", "remove"]
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        print_help()
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+        elif opt in ("-d", "--directory"):
+            directory = arg
+        elif opt in ("-f", "--format"):
+            mask_format = arg
+        elif opt == "--remove":
+            remove_originals = True
+
+    assert (
+        directory is not None
+    ), "No directory was specified. Type 'python mask_utilities.py -h' for help."
+    assert (
+        mask_format is not None
+    ), "No format was specified. Type 'python mask_utilities.py -h' for help."
+
+    convert_mask_files(directory, mask_format, remove_originals)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,529 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+from PIL import Image
+
+# webp is always lossless, exr requires the optional imageio package.
+FILE_FORMATS = ["png", "webp", "tiff", "exr", "npy"]
+FILE_EXTENSIONS = {
+    "png": ".png",
+    "webp": ".webp",
+    "tiff": ".tif",
+    "exr": ".exr",
+    "npy": ".npy",
+}
+
+# Streams of output files, which can be configured separately.
+OUTPUT_STREAMS = ["image", "mask", "debug"]
+
+# Streams, which only consist of binary masks and can therefore be saved with
+# 1 bit per pixel.
+MASK_STREAMS = ["mask"]
+
+
+class OutputWriter:
+    """Writes output files in background threads.
+
+    Jobs are arbitrary functions, which are submitted with their arguments
+    and executed by a thread pool, while the main thread continues with the
+    next image. Encoding images (PIL, zlib) releases the GIL, so that
+    threads suffice.
+
+    At most max_pending_jobs jobs are queued or running. Further submissions
+    block until a job has finished, so that slow disks do not fill up the
+    memory. Errors of jobs are raised in the main thread by the next call
+    of submit or flush. Submitted arguments must not be modified afterwards.
+
+    Usage:
+        with OutputWriter() as writer:
+            writer.submit(image.save, file_path)
+    """
+
+    def __init__(self, num_threads=2, max_pending_jobs=8):
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_threads, thread_name_prefix="output_writer"
+        )
+        self.slots = threading.BoundedSemaphore(max_pending_jobs)
+        self.futures = set()
+        self.futures_lock = threading.Lock()
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            # Do not mask the original exception.
+            self.executor.shutdown(wait=True)
+
+    def submit(self, function, *args, **kwargs):
+        self._raise_errors()
+
+        self.slots.acquire()
+
+        try:
+            future = self.executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        with self.futures_lock:
+            self.futures.add(future)
+
+        future.add_done_callback(self._on_job_done)
+
+        return future
+
+    def submit_after_pending(self, function, *args, **kwargs):
+        """Submit a job, which runs after all previously submitted jobs are
+        done. It is skipped, if one of them failed.
+        """
+        with self.futures_lock:
+            pending_futures = list(self.futures)
+
+        def job():
+            # Jobs start in the order of submission, so the pending jobs are
+            # already running on other threads and cannot deadlock.
+            wait(pending_futures)
+
+            for future in pending_futures:
+                if not future.cancelled() and future.exception() is not None:
+                    return
+
+            function(*args, **kwargs)
+
+        return self.submit(job)
+
+    def _on_job_done(self, future):
+        with self.futures_lock:
+            self.futures.discard(future)
+
+            if not future.cancelled() and future.exception() is not None:
+                self.errors.append(future.exception())
+
+        self.slots.release()
+
+    def _raise_errors(self):
+        with self.futures_lock:
+            if not self.errors:
+                return
+
+            error = self.errors[0]
+            self.errors.clear()
+
+        raise error
+
+    def flush(self):
+        """Wait until all submitted jobs are done."""
+        with self.futures_lock:
+            futures = list(self.futures)
+
+        wait(futures)
+        self._raise_errors()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+
+def write(writer, function, *args, **kwargs):
+    """Submit a job to writer or execute it right away, if writer is None."""
+    if writer is None:
+        function(*args, **kwargs)
+    else:
+        writer.submit(function, *args, **kwargs)
+
+
+def write_after_pending(writer, function, *args, **kwargs):
+    """Like write, but the job waits for all previously submitted jobs."""
+    if writer is None:
+        function(*args, **kwargs)
+    else:
+        writer.submit_after_pending(function, *args, **kwargs)
+
+
+@contextlib.contextmanager
+def atomic_file_path(file_path):
+    """Yield a temporary path next to file_path, which is renamed to
+    file_path, once the block has been completed without errors. Hence, an
+    interrupted write never leaves an incomplete file at file_path.
+
+    The temporary path keeps the extension of file_path, so that writers
+    that infer the format from the extension still work.
+    """
+    file_path = str(file_path)
+    directory, file_name = os.path.split(file_path)
+    temporary_file_path = os.path.join(
+        directory, f".tmp_{uuid.uuid4().hex[:8]}_{file_name}"
+    )
+
+    try:
+        yield temporary_file_path
+        os.replace(temporary_file_path, file_path)
+    finally:
+        if os.path.exists(temporary_file_path):
+            os.remove(temporary_file_path)
+
+
+def get_file_checksum(file_path):
+    checksum = hashlib.sha256()
+
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+class Manifest:
+    """Record of the completed images of a dataset, which allows to resume
+    an interrupted generation.
+
+    The manifest is a manifest.jsonl file in the output directory with one
+    line per completed image, which holds the image id, its seed base and
+    the size and checksum of each of its files (relative to the output
+    directory). Lines are appended with a single write, so that several
+    worker processes can share a manifest. Incomplete lines (e.g. after a
+    crash) are ignored.
+
+    An image is complete, if it has been recorded with the same seed base
+    and all of its files still exist and match their checksums.
+    """
+
+    FILE_NAME = "manifest.jsonl"
+
+    def __init__(self, output_directory, verify_checksums=True):
+        self.output_directory = str(output_directory)
+        self.file_path = os.path.join(self.output_directory, self.FILE_NAME)
+        self.verify_checksums = verify_checksums
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        entries = dict()
+
+        if not os.path.isfile(self.file_path):
+            return entries
+
+        with open(self.file_path) as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                # Later entries supersede earlier ones.
+                entries[entry["image_id"]] = entry
+
+        return entries
+
+    def is_complete(self, image_id, seed_base):
+        entry = self.entries.get(image_id)
+
+        if entry is None or entry["seed_base"] != seed_base:
+            return False
+
+        for relative_file_path, file_entry in entry["files"].items():
+            file_path = os.path.join(self.output_directory, relative_file_path)
+
+            if not os.path.isfile(file_path):
+                return False
+
+            if os.path.getsize(file_path) != file_entry["size"]:
+                return False
+
+            if (
+                self.verify_checksums
+                and get_file_checksum(file_path) != file_entry["sha256"]
+            ):
+                return False
+
+        return True
+
+    def record(self, image_id, seed_base, file_paths):
+        """Record an image as complete, once all of its files are written."""
+        files = dict()
+
+        for file_path in file_paths:
+            relative_file_path = os.path.relpath(
+                file_path, self.output_directory
+            ).replace(os.sep, "/")
+            files[relative_file_path] = {
+                "size": os.path.getsize(file_path),
+                "sha256": get_file_checksum(file_path),
+            }
+
+        entry = {"image_id": image_id, "seed_base": seed_base, "files": files}
+        line = (json.dumps(entry) + "\n").encode()
+
+        with self.lock:
+            os.makedirs(self.output_directory, exist_ok=True)
+
+            # Terminate an incomplete last line of a crashed process.
+            if not self._ends_with_newline():
+                line = b"\n" + line
+
+            file_descriptor = os.open(
+                self.file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+            )
+            try:
+                os.write(file_descriptor, line)
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)
+
+            self.entries[image_id] = entry
+
+    def _ends_with_newline(self):
+        if not os.path.isfile(self.file_path):
+            return True
+
+        with open(self.file_path, "rb") as manifest_file:
+            manifest_file.seek(0, os.SEEK_END)
+
+            if manifest_file.tell() == 0:
+                return True
+
+            manifest_file.seek(-1, os.SEEK_END)
+            return manifest_file.read(1) == b"\n"
+
+
+class OutputFormat:
+    """File format of an output stream.
+
+    file_format: One of FILE_FORMATS.
+    compression: Compression in percent (0-100), like the compression of
+        Blender's image settings. None uses the default of the format. For
+        webp, it controls the effort of the (lossless) encoder.
+    pack_bits: Save binary masks with 1 bit per pixel (png and tiff only).
+    """
+
+    def __init__(self, file_format="png", compression=None, pack_bits=False):
+        assert (
+            file_format in FILE_FORMATS
+        ), f"Unknown file format: {file_format}"
+
+        if compression is not None:
+            assert (
+                0 <= compression <= 100
+            ), f"Expected compression in [0, 100], got {compression}."
+
+        if pack_bits and file_format not in ["png", "tiff"]:
+            raise ValueError(
+                f"Bit packing is not supported for {file_format} files."
+            )
+
+        self.file_format = file_format
+        self.compression = compression
+        self.pack_bits = pack_bits
+
+    def __repr__(self):
+        return format_output_format(self)
+
+    @property
+    def extension(self):
+        return FILE_EXTENSIONS[self.file_format]
+
+    def get_file_path(self, file_path):
+        """Replace the extension of file_path with the one of the format."""
+        return os.path.splitext(str(file_path))[0] + self.extension
+
+    def save(self, array, file_path):
+        """Save an image array and return the path of the written file.
+
+        Boolean arrays are saved as masks, with values 0 and 255 or, if
+        pack_bits is set, with 1 bit per pixel.
+        """
+        file_path = self.get_file_path(file_path)
+        array = np.asarray(array)
+
+        with atomic_file_path(file_path) as temporary_file_path:
+            if self.file_format == "npy":
+                np.save(temporary_file_path, array)
+            elif self.file_format == "exr":
+                _save_exr(array, temporary_file_path)
+            else:
+                self._save_with_pil(array, temporary_file_path)
+
+        return file_path
+
+    def _save_with_pil(self, array, file_path):
+        if array.dtype == bool:
+            if self.pack_bits:
+                image = Image.fromarray(array).convert("1")
+            else:
+                image = Image.fromarray(array.astype(np.uint8) * 255)
+        else:
+            image = Image.fromarray(_to_uint8(array))
+
+        if self.file_format == "png":
+            options = {"optimize": False}
+            if self.compression is not None:
+                # Like Blender, map percent to zlib levels.
+                options["compress_level"] = int(self.compression / 11.1111)
+        elif self.file_format == "webp":
+            options = {"lossless": True}
+            if self.compression is not None:
+                options["quality"] = self.compression
+                options["method"] = round(self.compression / 100 * 6)
+        elif not self.compression:
+            options = {"compression": None}
+        elif self.pack_bits:
+            options = {"compression": "group4"}
+        else:
+            options = {"compression": "tiff_deflate"}
+
+        image.save(file_path, **options)
+
+
+def _to_uint8(array):
+    if np.issubdtype(array.dtype, np.floating):
+        return np.round(np.clip(array, 0, 1) * 255).astype(np.uint8)
+
+    return array
+
+
+def _save_exr(array, file_path):
+    try:
+        import imageio
+    except ImportError:
+        raise ImportError(
+            "Saving arrays as exr files requires the imageio package."
+        )
+
+    if array.dtype == bool:
+        array = array.astype(np.float32)
+    elif not np.issubdtype(array.dtype, np.floating):
+        array = array / np.iinfo(array.dtype).max
+
+    imageio.imwrite(file_path, array.astype(np.float32))
+
+
+def parse_output_format(format_string, stream=None):
+    """Parse a format string of the form <format>[:<compression>][:1bit],
+    e.g. "png", "png:15", "tiff:0:1bit" or "npy".
+
+    If the output stream is given, 1 bit packing is only accepted for
+    MASK_STREAMS.
+    """
+    file_format, *options = format_string.lower().split(":")
+
+    compression = None
+    pack_bits = False
+
+    for option in options:
+        if option == "1bit":
+            pack_bits = True
+        else:
+            try:
+                compression = int(option)
+            except ValueError:
+                raise ValueError(
+                    f"Unknown option of output format {format_string}: "
+                    f"{option}"
+                )
+
+    if pack_bits and stream is not None and stream not in MASK_STREAMS:
+        raise ValueError(
+            f"Bit packing is only supported for mask output, not for "
+            f"{stream} output: {format_string}"
+        )
+
+    return OutputFormat(file_format, compression, pack_bits)
+
+
+def format_output_format(output_format):
+    """Inverse of parse_output_format."""
+    format_string = output_format.file_format
+
+    if output_format.compression is not None:
+        format_string += f":{output_format.compression}"
+
+    if output_format.pack_bits:
+        format_string += ":1bit"
+
+    return format_string
+
+
+# Defaults of the output streams. The debug stream is disabled by default.
+DEFAULT_OUTPUT_FORMATS = {
+    "image": OutputFormat("png", compression=0),
+    "mask": OutputFormat("png", compression=15),
+    "debug": None,
+}
+
+
+def _get_benchmark_data(resolution, rng):
+    width, height = resolution
+    y, x = np.mgrid[0:height, 0:width]
+
+    # A smooth image with noise, similar to the rendered images.
+    image = 0.5 + 0.25 * np.sin(x / 37) * np.cos(y / 53)
+    image += rng.normal(0, 0.03, image.shape)
+    image = np.round(np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+    # A few discs, similar to an instance mask.
+    mask = np.zeros((height, width), dtype=bool)
+    for center_x, center_y, radius in zip(
+        rng.uniform(0, width, 20),
+        rng.uniform(0, height, 20),
+        rng.uniform(10, 60, 20),
+    ):
+        mask |= (x - center_x) ** 2 + (y - center_y) ** 2 < radius ** 2
+
+    return image, mask
+
+
+def benchmark(resolution=(1280, 960), output_formats=None, num_repeats=3):
+    """Print the bytes per file and encode times of output formats."""
+    if output_formats is None:
+        output_formats = [
+            "png:0",
+            "png:15",
+            "png:90",
+            "png:15:1bit",
+            "webp:0",
+            "webp:50",
+            "tiff:0",
+            "tiff:50",
+            "tiff:0:1bit",
+            "tiff:50:1bit",
+            "npy",
+        ]
+
+    image, mask = _get_benchmark_data(resolution, np.random.default_rng(0))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for format_string in output_formats:
+            output_format = parse_output_format(format_string)
+
+            for name, array in [("image", image), ("mask", mask)]:
+                if output_format.pack_bits and name == "image":
+                    continue
+
+                file_path = os.path.join(directory, name)
+
+                start_time = time.perf_counter()
+                for _ in range(num_repeats):
+                    file_path = output_format.save(array, file_path)
+                elapsed_time = (time.perf_counter() - start_time) / num_repeats
+
+                print(
+                    f"{format_string:>12} {name:>5}: "
+                    f"{os.path.getsize(file_path) / 1024:8.1f} KiB, "
+                    f"{elapsed_time * 1000:7.1f} ms"
+                )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+
+import itertools
+import math
+import time
+
+import numpy as np
+from scipy import spatial
+
+# Offsets of a cell and its direct neighbors in the spatial hash.
+_NEIGHBOR_CELL_OFFSETS = np.array(
+    list(itertools.product([-1, 0, 1], repeat=3))
+)
+
+
+def _get_random_generator(rng):
+    # Fall back to the global numpy state, which is seeded by
+    # recipe_utilities.set_random_seed.
+    return np.random if rng is None else rng
+
+
+def _get_minimum_distances(radii_a, radii_b, max_overlap):
+    return (radii_a + radii_b) * (1 - max_overlap)
+
+
+def place_by_random_sequential_addition(
+    radii,
+    lower_boundaries_xyz,
+    upper_boundaries_xyz,
+    max_overlap=0.0,
+    max_attempts=20,
+    num_candidates_per_attempt=32,
+    rng=None,
+):
+    """Place spheres one after another at random, non-overlapping positions.
+
+    The spheres are placed from largest to smallest. For each sphere, up to
+    max_attempts batches of random candidate positions are checked against
+    the already placed neighbors at once, which are looked up in a spatial
+    hash.
+    max_overlap is the tolerated overlap as fraction of the sum of the radii
+    of two spheres. If no valid position is found, then the candidate with
+    the smallest overlap is used.
+
+    Returns the (N, 3) array of positions and the number of spheres that
+    could not be placed without (excessive) overlaps.
+    """
+    rng = _get_random_generator(rng)
+
+    radii = np.asarray(radii, dtype=float)
+    lower_boundaries_xyz = np.asarray(lower_boundaries_xyz, dtype=float)
+    upper_boundaries_xyz = np.asarray(upper_boundaries_xyz, dtype=float)
+
+    num_spheres = len(radii)
+    positions = np.zeros((num_spheres, 3))
+
+    if not num_spheres:
+        return positions, 0
+
+    cell_size = max(2 * radii.max(), np.finfo(float).eps)
+    cells = dict()
+    num_overlapping = 0
+
+    for sphere_id in np.argsort(-radii, kind="stable"):
+        radius = radii[sphere_id]
+        best_position = None
+        best_overlap = np.inf
+
+        for _ in range(max_attempts):
+            candidates = rng.uniform(
+                lower_boundaries_xyz,
+                upper_boundaries_xyz,
+                size=(num_candidates_per_attempt, 3),
+            )
+
+            neighbor_ids = _get_neighbor_ids(cells, candidates, cell_size)
+
+            if neighbor_ids:
+                distances = spatial.distance.cdist(
+                    candidates, positions[neighbor_ids]
+                )
+                overlaps = np.max(
+                    _get_minimum_distances(
+                        radius, radii[neighbor_ids], max_overlap
+                    )
+                    - distances,
+                    axis=1,
+                )
+            else:
+                overlaps = np.full(num_candidates_per_attempt, -np.inf)
+
+            candidate_id = np.argmin(overlaps)
+
+            if overlaps[candidate_id] < best_overlap:
+                best_overlap = overlaps[candidate_id]
+                best_position = candidates[candidate_id]
+
+            if best_overlap <= 0:
+                break
+
+        if best_overlap > 0:
+            num_overlapping += 1
+
+        positions[sphere_id] = best_position
+        cell = tuple(np.floor(best_position / cell_size).astype(int))
+        cells.setdefault(cell, []).append(sphere_id)
+
+    return positions, num_overlapping
+
+
+def _get_neighbor_ids(cells, positions, cell_size):
+    position_cells = np.floor(positions / cell_size).astype(int)
+    neighbor_cells = (
+        position_cells[:, np.newaxis, :] + _NEIGHBOR_CELL_OFFSETS
+    ).reshape(-1, 3)
+
+    neighbor_ids = []
+
+    for neighbor_cell in np.unique(neighbor_cells, axis=0):
+        neighbor_ids += cells.get(tuple(neighbor_cell), [])
+
+    return neighbor_ids
+
+
+def place_by_repulsion(
+    radii,
+    lower_boundaries_xyz,
+    upper_boundaries_xyz,
+    max_overlap=0.0,
+    max_iterations=200,
+    positions=None,
+    rng=None,
+):
+    """Push overlapping spheres apart until no (excessive) overlaps remain.
+
+    Starting from random (or given) positions, every overlapping pair is
+    moved apart symmetrically along the line connecting their centers in
+    each iteration. Positions are kept within the boundaries.
+
+    Returns the (N, 3) array of positions and the number of spheres that
+    still overlap after max_iterations.
+    """
+    rng = _get_random_generator(rng)
+
+    radii = np.asarray(radii, dtype=float)
+    lower_boundaries_xyz = np.asarray(lower_boundaries_xyz, dtype=float)
+    upper_boundaries_xyz = np.asarray(upper_boundaries_xyz, dtype=float)
+
+    num_spheres = len(radii)
+
+    if positions is None:
+        positions = rng.uniform(
+            lower_boundaries_xyz, upper_boundaries_xyz, size=(num_spheres, 3)
+        )
+    else:
+        positions = np.array(positions, dtype=float)
+
+    if num_spheres < 2:
+        return positions, 0
+
+    search_radius = 2 * radii.max()
+
+    for _ in range(max_iterations):
+        ids_a, ids_b, overlaps, directions = _get_overlaps(
+            positions, radii, search_radius, max_overlap, rng
+        )
+
+        if not len(overlaps):
+            return positions, 0
+
+        shifts = directions * (overlaps[:, np.newaxis] / 2)
+
+        displacements = np.zeros_like(positions)
+        np.add.at(displacements, ids_a, -shifts)
+        np.add.at(displacements, ids_b, shifts)
+
+        positions = np.clip(
+            positions + displacements,
+            lower_boundaries_xyz,
+            upper_boundaries_xyz,
+        )
+
+    ids_a, ids_b, _, _ = _get_overlaps(
+        positions, radii, search_radius, max_overlap, rng
+    )
+
+    return positions, len(np.union1d(ids_a, ids_b))
+
+
+def _get_overlaps(positions, radii, search_radius, max_overlap, rng):
+    tree = spatial.cKDTree(positions)
+    pairs = tree.query_pairs(search_radius, output_type="ndarray")
+
+    ids_a, ids_b = pairs[:, 0], pairs[:, 1]
+
+    differences = positions[ids_b] - positions[ids_a]
+    distances = np.linalg.norm(differences, axis=1)
+    overlaps = (
+        _get_minimum_distances(radii[ids_a], radii[ids_b], max_overlap)
+        - distances
+    )
+
+    # Small tolerance, so that touching spheres do not count as overlapping.
+    is_overlapping = overlaps > 1e-9 * search_radius
+
+    ids_a = ids_a[is_overlapping]
+    ids_b = ids_b[is_overlapping]
+    overlaps = overlaps[is_overlapping]
+    differences = differences[is_overlapping]
+    distances = distances[is_overlapping]
+
+    # Push coincident spheres apart in a random direction.
+    is_coincident = distances == 0
+    differences[is_coincident] = rng.normal(size=(is_coincident.sum(), 3))
+    distances[is_coincident] = np.linalg.norm(
+        differences[is_coincident], axis=1
+    )
+
+    directions = differences / distances[:, np.newaxis]
+
+    return ids_a, ids_b, overlaps, directions
+
+
+def get_number_of_spheres_for_coverage(
+    radii, lower_boundaries_xyz, upper_boundaries_xyz, target_coverage
+):
+    """Get how many of the spheres (in the given order) are needed, so that
+    their projected areas cover the target fraction of the xy-region.
+    """
+    extents = np.subtract(upper_boundaries_xyz, lower_boundaries_xyz)
+    width, height = extents[:2]
+    projected_areas = np.pi * np.asarray(radii, dtype=float) ** 2
+    covered_areas = np.cumsum(projected_areas)
+
+    target_area = target_coverage * width * height
+
+    return int(np.searchsorted(covered_areas, target_area, side="right"))
+
+
+def benchmark(num_spheres=400, resolution=(1032, 825), mean_radius=15):
+    rng = np.random.default_rng(0)
+    radii = rng.lognormal(math.log(mean_radius), math.log(1.5), num_spheres)
+    lower_boundaries_xyz = (-resolution[0] / 2, -resolution[1] / 2, -10)
+    upper_boundaries_xyz = (resolution[0] / 2, resolution[1] / 2, 10)
+
+    for function in [place_by_random_sequential_addition, place_by_repulsion]:
+        start_time = time.perf_counter()
+        _, num_overlapping = function(
+            radii, lower_boundaries_xyz, upper_boundaries_xyz, rng=rng
+        )
+        elapsed_time = time.perf_counter() - start_time
+
+        print(
+            f"{function.__name__}: {elapsed_time:.3f} s, "
+            f"{num_overlapping}/{num_spheres} overlapping"
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
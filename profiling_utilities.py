@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+import contextlib
+import functools
+import getopt
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+REPORT_FILE_PATTERN = "profile_*.jsonl"
+
+
+class Profiler:
+    """Collects named, nestable timing spans and counters per image.
+
+    Spans are identified by the path of their names (e.g.
+    "render_image/render_to_variable"), so that the same function is
+    reported separately for each caller. Times are wall clock times of the
+    main thread, i.e. work of an output_utilities.OutputWriter is only
+    included as far as the main thread waits for it.
+    """
+
+    def __init__(self):
+        self.span_names = []
+        self.records = []
+        self.record = self._new_record(None)
+
+    @staticmethod
+    def _new_record(image_id):
+        return {
+            "image_id": image_id,
+            "time": 0.0,
+            "spans": defaultdict(lambda: {"count": 0, "time": 0.0}),
+            "counters": defaultdict(int),
+        }
+
+    @contextlib.contextmanager
+    def span(self, name):
+        self.span_names.append(name)
+        path = "/".join(self.span_names)
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            self.span_names.pop()
+
+            span = self.record["spans"][path]
+            span["count"] += 1
+            span["time"] += elapsed_time
+
+    def count(self, name, n=1):
+        self.record["counters"][name] += n
+
+    @contextlib.contextmanager
+    def image(self, image_id):
+        """Collect the spans and counters of an image in a separate record."""
+        previous_record = self.record
+        self.record = self._new_record(image_id)
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.record["time"] = time.perf_counter() - start_time
+            self.records.append(self.record)
+            self.record = previous_record
+
+    def write_report(self, output_directory, name="profile"):
+        """Write one JSON line per image to <name>.jsonl and the summary of
+        all images to <name>_summary.json.
+        """
+        os.makedirs(output_directory, exist_ok=True)
+        output_directory = Path(output_directory)
+
+        with open(output_directory / f"{name}.jsonl", "a") as report_file:
+            for record in self.records:
+                report_file.write(json.dumps(record) + "\n")
+
+        with open(output_directory / f"{name}_summary.json", "w") as file:
+            json.dump(summarize(self.records), file, indent=2)
+
+        self.records = []
+
+
+def _get_statistics(values):
+    values = np.asarray(values, dtype=float)
+
+    return {
+        "count": len(values),
+        "total": float(np.sum(values)),
+        "mean": float(np.mean(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(np.max(values)),
+    }
+
+
+def summarize(records):
+    """Aggregate the per image times of each span and the per image values
+    of each counter over all images.
+    """
+    span_times = defaultdict(list)
+    counter_values = defaultdict(list)
+
+    for record in records:
+        for path, span in record["spans"].items():
+            span_times[path].append(span["time"])
+
+        for name, value in record["counters"].items():
+            counter_values[name].append(value)
+
+    return {
+        "num_images": len(records),
+        "image": _get_statistics([record["time"] for record in records])
+        if records
+        else None,
+        "spans": {
+            path: _get_statistics(times)
+            for path, times in sorted(span_times.items())
+        },
+        "counters": {
+            name: _get_statistics(values)
+            for name, values in sorted(counter_values.items())
+        },
+    }
+
+
+profiler = Profiler()
+
+
+def span(name):
+    """Time a block as span of the global profiler:
+    with span("render"):
+        ...
+    """
+    return profiler.span(name)
+
+
+def profiled(name=None):
+    """Decorator, which times every call of a function as span."""
+
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, n=1):
+    profiler.count(name, n)
+
+
+def profile_image(image_id):
+    return profiler.image(image_id)
+
+
+def write_report(output_directory, name="profile"):
+    profiler.write_report(output_directory, name)
+
+
+def summarize_reports(directory):
+    """Summarize the per image reports of all workers in a directory."""
+    records = []
+
+    for report_file_path in sorted(Path(directory).glob(REPORT_FILE_PATTERN)):
+        with open(report_file_path) as report_file:
+            records += [json.loads(line) for line in report_file]
+
+    return summarize(records)
+
+
+def print_summary(summary):
+    print(f"Images: {summary['num_images']}")
+
+    if summary["image"] is not None:
+        print(
+            f"Time per image: p50 {summary['image']['p50']:.3f} s, "
+            f"p95 {summary['image']['p95']:.3f} s"
+        )
+
+    print(f"\n{'span':<60} {'p50 [s]':>9} {'p95 [s]':>9} {'total [s]':>10}")
+    for path, statistics in summary["spans"].items():
+        print(
+            f"{path:<60} {statistics['p50']:9.3f} {statistics['p95']:9.3f} "
+            f"{statistics['total']:10.1f}"
+        )
+
+    print(f"\n{'counter':<60} {'p50':>9} {'p95':>9} {'total':>10}")
+    for name, statistics in summary["counters"].items():
+        print(
+            f"{name:<60} {statistics['p50']:9.0f} {statistics['p95']:9.0f} "
+            f"{statistics['total']:10.0f}"
+        )
+
+
+def print_help():
+    print("Usage:")
+    print("profiling_utilities.py -d <directory>")
+    print("profiling_utilities.py --directory <directory>")
+    print("")
+    print(f"Summarizes all {REPORT_FILE_PATTERN} reports in a directory.")
+    sys.exit(2)
+
+
+def main(argv):
+    directory = None
+
+    try:
+        opts, args = getopt.getopt(argv, "hd:", ["help", "directory="])
+    except getopt.GetoptError as err:
+        print(err)
+        print_help()
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+        elif opt in ("-d", "--directory"):
+            directory = arg
+
+    assert (
+        directory is not None
+    ), "No directory was specified. Type 'python profiling_utilities.py -h' for help."
+
+    summary = summarize_reports(directory)
+
+    with open(Path(directory) / "profile_summary.json", "w") as file:
+        json.dump(summary, file, indent=2)
+
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
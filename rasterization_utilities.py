@@ -0,0 +1,206 @@
+import numpy as np
+
+# Upper bound of the number of (triangle, pixel) candidates, which are
+# tested at once, to limit the memory consumption.
+MAX_NUM_CANDIDATES = 2 ** 22
+
+
+def _get_candidate_pixels(triangles, resolution):
+    """Get all pixels, whose centers lie in the bounding box of a triangle.
+
+    Returns the triangle index as well as the x and y index of each
+    candidate pixel.
+    """
+    width, height = resolution
+    xy = triangles[:, :, :2]
+
+    # Pixel i covers [i, i + 1), its center lies at i + 0.5.
+    x_min = np.clip(np.ceil(xy[:, :, 0].min(axis=1) - 0.5), 0, width)
+    x_max = np.clip(np.floor(xy[:, :, 0].max(axis=1) - 0.5), -1, width - 1)
+    y_min = np.clip(np.ceil(xy[:, :, 1].min(axis=1) - 0.5), 0, height)
+    y_max = np.clip(np.floor(xy[:, :, 1].max(axis=1) - 0.5), -1, height - 1)
+
+    num_x = np.maximum(x_max - x_min + 1, 0).astype(np.int64)
+    num_y = np.maximum(y_max - y_min + 1, 0).astype(np.int64)
+    num_candidates = num_x * num_y
+
+    triangle_ids = np.repeat(np.arange(len(triangles)), num_candidates)
+    offsets = np.arange(num_candidates.sum()) - np.repeat(
+        np.cumsum(num_candidates) - num_candidates, num_candidates
+    )
+
+    x = x_min[triangle_ids].astype(np.int64) + offsets % num_x[triangle_ids]
+    y = y_min[triangle_ids].astype(np.int64) + offsets // num_x[triangle_ids]
+
+    return triangle_ids, x, y
+
+
+def _get_chunks(triangles, resolution):
+    """Split triangles in chunks of at most MAX_NUM_CANDIDATES candidates."""
+    width, height = resolution
+    xy = triangles[:, :, :2]
+
+    extents = np.clip(xy.max(axis=1) - xy.min(axis=1) + 1, 0, [width, height])
+    num_candidates = np.cumsum(np.prod(extents, axis=1))
+
+    start = 0
+    while start < len(triangles):
+        stop = np.searchsorted(
+            num_candidates,
+            num_candidates[start] + MAX_NUM_CANDIDATES,
+            side="right",
+        )
+        stop = max(stop, start + 1)
+        yield start, stop
+        start = stop
+
+
+def _rasterize(triangles, resolution):
+    """Yield the triangle index, the flat pixel index and the depth of every
+    pixel center that is covered by a triangle, chunk by chunk.
+
+    triangles is an (N, 3, 3) array of the pixel coordinates x, y (image
+    rows, top to bottom) and depth of the corners of N triangles.
+    """
+    width, _ = resolution
+
+    for start, stop in _get_chunks(triangles, resolution):
+        chunk = triangles[start:stop]
+        triangle_ids, x, y = _get_candidate_pixels(chunk, resolution)
+
+        corners = chunk[triangle_ids]
+        x0, y0, z0 = corners[:, 0].T
+        x1, y1, z1 = corners[:, 1].T
+        x2, y2, z2 = corners[:, 2].T
+
+        center_x = x + 0.5
+        center_y = y + 0.5
+
+        # Barycentric coordinates of the pixel centers.
+        denominator = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+        is_valid = denominator != 0
+        denominator = np.where(is_valid, denominator, 1)
+
+        weight_0 = (
+            (y1 - y2) * (center_x - x2) + (x2 - x1) * (center_y - y2)
+        ) / denominator
+        weight_1 = (
+            (y2 - y0) * (center_x - x2) + (x0 - x2) * (center_y - y2)
+        ) / denominator
+        weight_2 = 1 - weight_0 - weight_1
+
+        is_inside = (
+            is_valid & (weight_0 >= 0) & (weight_1 >= 0) & (weight_2 >= 0)
+        )
+
+        depths = weight_0 * z0 + weight_1 * z1 + weight_2 * z2
+
+        yield (
+            triangle_ids[is_inside] + start,
+            y[is_inside] * width + x[is_inside],
+            depths[is_inside],
+        )
+
+
+def rasterize_label_image(triangles, triangle_labels, resolution):
+    """Rasterize triangles with a z-buffer.
+
+    triangles is an (N, 3, 3) array of the pixel coordinates x, y (image
+    rows, top to bottom) and depth of the corners of N triangles and
+    triangle_labels holds the label of each triangle. Returns an integer
+    image of the label of the closest triangle in each pixel and 0 for the
+    background. Triangles with label 0 therefore only occlude.
+    """
+    width, height = resolution
+    triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    triangle_labels = np.asarray(triangle_labels)
+
+    depth_buffer = np.full(width * height, np.inf)
+    label_image = np.zeros(width * height, dtype=np.int64)
+
+    for triangle_ids, pixel_ids, depths in _rasterize(triangles, resolution):
+        # Find the closest triangle in each pixel of the chunk.
+        order = np.lexsort((depths, pixel_ids))
+        pixel_ids = pixel_ids[order]
+        is_first = np.ones(len(pixel_ids), dtype=bool)
+        is_first[1:] = pixel_ids[1:] != pixel_ids[:-1]
+
+        pixel_ids = pixel_ids[is_first]
+        depths = depths[order][is_first]
+        triangle_ids = triangle_ids[order][is_first]
+
+        is_closer = depths < depth_buffer[pixel_ids]
+        pixel_ids = pixel_ids[is_closer]
+
+        depth_buffer[pixel_ids] = depths[is_closer]
+        label_image[pixel_ids] = triangle_labels[triangle_ids[is_closer]]
+
+    return label_image.reshape(height, width)
+
+
+def rasterize_instance_masks(
+    triangles, triangle_instance_ids, num_instances, resolution
+):
+    """Rasterize the complete silhouette of each instance, ignoring
+    occlusions.
+
+    triangles is an (N, 3, 3) array like for rasterize_label_image and
+    triangle_instance_ids holds the instance (0 to num_instances - 1) of
+    each triangle. Yields a binary mask for each instance.
+    """
+    width, height = resolution
+    triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    triangle_instance_ids = np.asarray(triangle_instance_ids, dtype=np.int64)
+
+    keys = [np.empty(0, dtype=np.int64)]
+
+    for triangle_ids, pixel_ids, _ in _rasterize(triangles, resolution):
+        keys.append(
+            np.unique(
+                triangle_instance_ids[triangle_ids] * width * height
+                + pixel_ids
+            )
+        )
+
+    keys = np.unique(np.concatenate(keys))
+    instance_ids, pixel_ids = np.divmod(keys, width * height)
+    boundaries = np.searchsorted(instance_ids, np.arange(num_instances + 1))
+
+    for instance_id in range(num_instances):
+        mask = np.zeros(width * height, dtype=bool)
+        mask[
+            pixel_ids[boundaries[instance_id] : boundaries[instance_id + 1]]
+        ] = True
+        yield mask.reshape(height, width)
+
+
+def get_strand_triangles(strands, diameters):
+    """Triangulate projected strands as flat ribbons.
+
+    strands is an (N, M, 3) array of N strands with M vertices each, in
+    pixel coordinates x, y and depth, and diameters holds the diameter of
+    each strand in pixels. Every segment is drawn as a quad of two triangles,
+    which is perpendicular to the segment in the image plane. Returns an
+    (N * (M - 1) * 2, 3, 3) array.
+    """
+    strands = np.asarray(strands, dtype=np.float64)
+    radii = np.broadcast_to(np.asarray(diameters) / 2, strands.shape[:1])
+
+    starts = strands[:, :-1]
+    ends = strands[:, 1:]
+
+    directions = ends[..., :2] - starts[..., :2]
+    lengths = np.linalg.norm(directions, axis=-1, keepdims=True)
+    normals = np.stack([-directions[..., 1], directions[..., 0]], axis=-1)
+    normals = normals / np.where(lengths > 0, lengths, 1)
+    offsets = np.zeros(starts.shape)
+    offsets[..., :2] = normals * radii[:, np.newaxis, np.newaxis]
+
+    corners = [starts - offsets, starts + offsets, ends + offsets]
+    triangles_a = np.stack(corners, axis=-2)
+    corners = [starts - offsets, ends + offsets, ends - offsets]
+    triangles_b = np.stack(corners, axis=-2)
+
+    return np.concatenate(
+        [triangles_a.reshape(-1, 3, 3), triangles_b.reshape(-1, 3, 3)]
+    )
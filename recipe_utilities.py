@@ -1,12 +1,21 @@
+import getopt
 import math
 import random
 import string
+import sys
 import time
 
 import numpy as np
 import PIL
 from PIL import ImageEnhance
 
+from output_utilities import (
+    DEFAULT_OUTPUT_FORMATS,
+    OUTPUT_STREAMS,
+    parse_output_format,
+)
+from system_utilities import parse_shard_string, split_range
+
 
 class Timer:
     def __init__(self, name=None):
@@ -38,18 +47,59 @@ def _noise_to_image(noise_base, width, height, contrast=1, brightness=1):
     return noise_image
 
 
+def get_random_generator(rng=None):
+    """Return rng or, if it is None, a generator that is seeded from the
+    global numpy random state (see set_random_seed).
+    """
+    if rng is not None:
+        return rng
+
+    return np.random.default_rng(np.random.randint(0, 2 ** 31 - 1))
+
+
+def get_image_random_generator(image_id, seed_base=None):
+    """Return the random generator of an image.
+
+    It is derived from the child image_id of a SeedSequence with the seed
+    seed_base (equivalent to SeedSequence(seed_base).spawn(n)[image_id]), so
+    that the content of an image does not depend on the worker or shard that
+    renders it. By default, the seed base is taken from the arguments that
+    render.py passes to the recipe.
+    """
+    if seed_base is None:
+        seed_base = get_seed_base()
+
+    seed_sequence = np.random.SeedSequence(seed_base, spawn_key=(image_id,))
+
+    return np.random.default_rng(seed_sequence)
+
+
+def _get_noise_random_generator(seed, rng):
+    if seed is not None:
+        return np.random.default_rng(seed)
+
+    return get_random_generator(rng)
+
+
 def generate_gaussian_noise_image(
-    image_size, scale=1, seed=None, strength=1, contrast=1, brightness=1
+    image_size,
+    scale=1,
+    seed=None,
+    strength=1,
+    contrast=1,
+    brightness=1,
+    rng=None,
 ):
-    if seed is not None:
-        np.random.seed(seed)
+    rng = _get_noise_random_generator(seed, rng)
 
     width, height = image_size
 
     height_base = math.ceil(height / scale)
     width_base = math.ceil(width / scale)
 
-    noise_base = np.random.randn(height_base, width_base) * strength + 0.5
+    noise_base = (
+        rng.standard_normal((height_base, width_base)) * strength + 0.5
+    )
 
     noise_image = _noise_to_image(
         noise_base, width, height, contrast, brightness
@@ -59,17 +109,16 @@ def generate_gaussian_noise_image(
 
 
 def generate_uniform_noise_image(
-    image_size, scale=1, seed=None, contrast=1, brightness=1
+    image_size, scale=1, seed=None, contrast=1, brightness=1, rng=None
 ):
-    if seed is not None:
-        np.random.seed(seed)
+    rng = _get_noise_random_generator(seed, rng)
 
     width, height = image_size
 
     height_base = math.ceil(height / scale)
     width_base = math.ceil(width / scale)
 
-    noise_base = np.random.rand(height_base, width_base)
+    noise_base = rng.random((height_base, width_base))
 
     noise_image = _noise_to_image(
         noise_base, width, height, contrast, brightness
@@ -81,3 +130,102 @@ def generate_uniform_noise_image(
 def set_random_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
+
+
+def get_recipe_arguments():
+    """Parse the arguments that render.py passes to a recipe after "--"."""
+    argv = sys.argv
+    argv = argv[argv.index("--") + 1 :] if "--" in argv else []
+
+    opts, _ = getopt.getopt(
+        argv,
+        "",
+        ["shard=", "worker=", "seed-base=", "preset="]
+        + [f"{stream}-file-format=" for stream in OUTPUT_STREAMS],
+    )
+
+    arguments = {
+        "shard": (0, 1),
+        "worker": (0, 1),
+        "seed_base": 0,
+        "output_formats": dict(DEFAULT_OUTPUT_FORMATS),
+        "preset": None,
+    }
+
+    for opt, arg in opts:
+        if opt == "--shard":
+            arguments["shard"] = parse_shard_string(arg)
+        elif opt == "--worker":
+            arguments["worker"] = parse_shard_string(arg)
+        elif opt == "--seed-base":
+            arguments["seed_base"] = int(arg)
+        elif opt == "--preset":
+            arguments["preset"] = arg
+        elif opt.endswith("-file-format"):
+            stream = opt[2 : -len("-file-format")]
+            arguments["output_formats"][stream] = parse_output_format(
+                arg, stream
+            )
+
+    return arguments
+
+
+def get_image_ids(num_images, manifest=None):
+    """Return the image ids that the current Blender process should render.
+
+    The id range is first split into contiguous shards (one per machine),
+    which are then split among the local worker processes, so that the
+    workers of all shards together render every image exactly once.
+
+    If an output_utilities.Manifest is given, then images that it records
+    as complete (for the current seed base) are skipped, so that an
+    interrupted generation can be resumed.
+    """
+    arguments = get_recipe_arguments()
+
+    image_ids = range(num_images)
+    image_ids = split_range(image_ids, *arguments["shard"])
+    image_ids = split_range(image_ids, *arguments["worker"])
+
+    if manifest is not None:
+        num_image_ids = len(image_ids)
+        image_ids = [
+            image_id
+            for image_id in image_ids
+            if not manifest.is_complete(image_id, arguments["seed_base"])
+        ]
+
+        num_skipped = num_image_ids - len(image_ids)
+        if num_skipped:
+            print(f"Skipping {num_skipped} completed images.")
+
+    return image_ids
+
+
+def get_seed_base():
+    return get_recipe_arguments()["seed_base"]
+
+
+def get_worker_name():
+    """Return a name of the current Blender process, which is unique among
+    all shards and workers, e.g. for per-process report files.
+    """
+    arguments = get_recipe_arguments()
+    shard_index, _ = arguments["shard"]
+    worker_index, _ = arguments["worker"]
+
+    return f"shard{shard_index}_worker{worker_index}"
+
+
+def get_output_formats():
+    """Return the output_utilities.OutputFormat of each output stream, as
+    passed by render.py (e.g. --image-file-format png:15).
+    """
+    return get_recipe_arguments()["output_formats"]
+
+
+def get_render_preset():
+    """Return the name of the render preset, as passed by render.py (e.g.
+    --preset balanced), or None if no preset was selected.
+    """
+    return get_recipe_arguments()["preset"]
@@ -1,10 +1,8 @@
 import os
-import random
 import sys
 
 import bpy
 import numpy as np
-from PIL import Image, ImageEnhance, ImageFilter
 
 C = bpy.context
 D = bpy.data
@@ -16,54 +14,72 @@ if ROOT_DIR not in sys.path:
 
 import blender.particles  # isort:skip
 import blender.scene  # isort:skip
-from recipe_utilities import (
-    generate_gaussian_noise_image,  # isort:skip
-    set_random_seed,
+import blender.utilities  # isort:skip
+import compositing_utilities  # isort:skip
+import output_utilities  # isort:skip
+import profiling_utilities  # isort:skip
+from recipe_utilities import (  # isort:skip
+    get_image_ids,
+    get_image_random_generator,
+    get_output_formats,
+    get_render_preset,
+    get_seed_base,
+    get_worker_name,
 )
 
-from spline_utilities import calculate_spline_length  # isort:skip
+from spline_utilities import calculate_spline_lengths  # isort:skip
 
+BACKGROUND_NOISE_PARAMETERS = {
+    "background": dict(scale=200, strength=0.1, contrast=0.2, brightness=0.6),
+    "background_noise": dict(
+        scale=20, strength=0.1, contrast=0.2, brightness=0.6
+    ),
+}
 
-def create_fiber_fraction(diameter):
+
+def create_fiber_fraction(diameter, rng):
     class_names = ["loop", "noloop"]
     class_weights = [1, 1]
 
     number_mu_sigma = [0, 0.2]
     hair_length_factor_minmax = [0.3, 1]
 
-    num_fibers_total = int(np.ceil(np.random.lognormal(*number_mu_sigma)))
+    num_fibers_total = int(np.ceil(rng.lognormal(*number_mu_sigma)))
 
-    num_fibers_loop = random.choices(
-        class_names, weights=class_weights, k=num_fibers_total
-    ).count("loop")
+    class_probabilities = np.divide(class_weights, np.sum(class_weights))
+    num_fibers_loop = (
+        rng.choice(class_names, p=class_probabilities, size=num_fibers_total)
+        .tolist()
+        .count("loop")
+    )
 
     num_fibers_noloop = num_fibers_total - num_fibers_loop
 
     fibers_loop = create_particle_fraction(
-        "loop", num_fibers_loop, diameter, hair_length_factor_minmax
+        "loop", num_fibers_loop, diameter, hair_length_factor_minmax, rng
     )
 
     fibers_noloop = create_particle_fraction(
-        "noloop", num_fibers_noloop, diameter, hair_length_factor_minmax
+        "noloop", num_fibers_noloop, diameter, hair_length_factor_minmax, rng
     )
 
     return fibers_loop + fibers_noloop
 
 
-def create_clutter_fraction(diameter):
+def create_clutter_fraction(diameter, rng):
     class_name = "clutter"
     number_min_max = [0, 2]
     hair_length_factor_minmax = [0.3, 1]
 
-    number = np.random.randint(*number_min_max)
+    number = rng.integers(*number_min_max)
 
     return create_particle_fraction(
-        class_name, number, diameter, hair_length_factor_minmax
+        class_name, number, diameter, hair_length_factor_minmax, rng
     )
 
 
 def create_particle_fraction(
-    class_name, number, diameter, hair_length_factor_minmax
+    class_name, number, diameter, hair_length_factor_minmax, rng
 ):
     primitive = load_primitive(class_name)
     blender.particles.show(primitive)
@@ -71,16 +87,16 @@ def create_particle_fraction(
     particles = list()
 
     for particle_id in range(number):
-        diameter *= np.random.uniform(0.8, 1.2)
+        diameter *= rng.uniform(0.8, 1.2)
 
         particle_name = class_name + "{:06d}".format(particle_id)
         particle = blender.particles.duplicate(primitive, particle_name)
 
-        hair_length_factor = random.uniform(*hair_length_factor_minmax)
+        hair_length_factor = rng.uniform(*hair_length_factor_minmax)
         blender.particles.set_hair_length_factor(particle, hair_length_factor)
         blender.particles.set_hair_diameter(particle, diameter)
-        blender.particles.randomize_shape(particle)
-        blender.particles.rotate_randomly(particle)
+        blender.particles.randomize_shape(particle, rng)
+        blender.particles.rotate_randomly(particle, rng)
 
         particle["class"] = class_name
 
@@ -89,45 +105,139 @@ def create_particle_fraction(
     return particles
 
 
-def generate_samples(num_images, output_folder_path, resolution):
-    for image_id in range(num_images):
-        set_random_seed(image_id)
-
-        with blender.scene.TemporaryState():
-            setup_scene(resolution)
-            particles = create_geometry(resolution)
-            image = render_image(resolution)
-            save_output_data(
-                image,
-                image_id,
-                output_folder_path,
-                particles,
-                resolution,
+def generate_samples(
+    num_images,
+    output_folder_path,
+    resolution,
+    spline_file_format="per_spline_csv",
+    noise_bank_directory=None,
+    num_noise_bank_layers=32,
+    output_formats=None,
+    render_preset=None,
+):
+    if output_formats is None:
+        output_formats = output_utilities.DEFAULT_OUTPUT_FORMATS
+
+    noise_banks = None
+    if noise_bank_directory is not None:
+        noise_banks = create_noise_banks(
+            noise_bank_directory, resolution, num_noise_bank_layers
+        )
+
+    # Skip images that were completed by a previous, interrupted run.
+    manifest = output_utilities.Manifest(output_folder_path)
+    seed_base = get_seed_base()
+
+    blender.utilities.count_operator_calls()
+
+    # Write the output of an image, while the next one is being rendered.
+    with output_utilities.OutputWriter() as writer:
+        for image_id in get_image_ids(num_images, manifest):
+            # Seed every image individually, so that its content does not
+            # depend on which worker renders it.
+            rng = get_image_random_generator(image_id)
+
+            with profiling_utilities.profile_image(
+                image_id
+            ), blender.scene.TemporaryState():
+                setup_scene(resolution, render_preset)
+                particles = create_geometry(resolution, rng)
+                image = render_image(resolution, rng, noise_banks)
+                file_paths = save_output_data(
+                    image,
+                    image_id,
+                    output_folder_path,
+                    particles,
+                    resolution,
+                    spline_file_format,
+                    writer,
+                    output_formats,
+                )
+
+            # Record the image, once all of its files are written.
+            output_utilities.write_after_pending(
+                writer, manifest.record, image_id, seed_base, file_paths
             )
 
+    # Summarize with: python profiling_utilities.py -d <output>/profile
+    profiling_utilities.write_report(
+        os.path.join(output_folder_path, "profile"),
+        f"profile_{get_worker_name()}",
+    )
+
 
+@profiling_utilities.profiled()
 def save_output_data(
-    image, image_id, output_folder_path, particles_fiber, resolution
+    image,
+    image_id,
+    output_folder_path,
+    particles_fiber,
+    resolution,
+    spline_file_format="per_spline_csv",
+    writer=None,
+    output_formats=None,
 ):
+    if output_formats is None:
+        output_formats = output_utilities.DEFAULT_OUTPUT_FORMATS
+
     os.makedirs(output_folder_path, exist_ok=True)
     image_id_string = f"synthetic{image_id:06d}"
-    save_image(image, output_folder_path, image_id_string)
-    blender.scene.save_spline_data(
+    image_file_path = save_image(
+        image,
+        output_folder_path,
+        image_id_string,
+        writer,
+        output_formats["image"],
+    )
+
+    file_paths = [image_file_path]
+
+    if output_formats["debug"] is not None:
+        file_paths += save_debug_layers(
+            resolution,
+            output_folder_path,
+            image_id_string,
+            writer,
+            output_formats["debug"],
+        )
+
+    file_paths += blender.scene.save_spline_data(
         particles_fiber,
         output_folder_path,
         image_id_string,
         resolution,
+        file_format=spline_file_format,
+        writer=writer,
     )
 
+    return file_paths
 
-def render_image(resolution):
+
+def create_noise_banks(noise_bank_directory, resolution, num_layers):
+    # The background layers are statistically interchangeable, so they are
+    # drawn from banks of pre-generated layers.
+    return {
+        layer_name: compositing_utilities.NoiseBank(
+            noise_bank_directory,
+            resolution,
+            num_layers=num_layers,
+            **BACKGROUND_NOISE_PARAMETERS[layer_name],
+        )
+        for layer_name in BACKGROUND_NOISE_PARAMETERS
+    }
+
+
+@profiling_utilities.profiled()
+def render_image(resolution, rng, noise_banks=None):
+    compositor = compositing_utilities.get_layer_compositor(resolution)
     (
         background_layer,
         background_noise_layer,
         noise_layer,
         particle_layer,
-    ) = create_image_layers(resolution)
+    ) = create_image_layers(compositor, rng, noise_banks)
     final_image = compose_layers(
+        compositor,
         background_layer,
         background_noise_layer,
         noise_layer,
@@ -136,7 +246,7 @@ def render_image(resolution):
     return final_image
 
 
-def place_clutter_on_fibers(particles_clutter, particles_fiber):
+def place_clutter_on_fibers(particles_clutter, particles_fiber, rng):
 
     num_particles_clutter = len(particles_clutter)
 
@@ -145,77 +255,139 @@ def place_clutter_on_fibers(particles_clutter, particles_fiber):
 
     vertices_sets = blender.particles.get_hair_spline_vertices(particles_fiber)
 
-    fiber_lengths = [
-        calculate_spline_length(vertices) for vertices in vertices_sets
-    ]
+    fiber_lengths = calculate_spline_lengths(vertices_sets)
 
     # Choose host fibers.
-    host_fiber_vertices_sets = random.choices(
-        vertices_sets, weights=fiber_lengths, k=num_particles_clutter
+    host_fiber_ids = rng.choice(
+        len(vertices_sets),
+        p=fiber_lengths / np.sum(fiber_lengths),
+        size=num_particles_clutter,
     )
 
-    for host_fiber_vertices, particle_clutter in zip(
-        host_fiber_vertices_sets, particles_clutter
+    for host_fiber_id, particle_clutter in zip(
+        host_fiber_ids, particles_clutter
     ):
         # Choose vertex.
-        position = random.choice(host_fiber_vertices)
+        host_fiber_vertices = vertices_sets[host_fiber_id]
+        position = host_fiber_vertices[rng.integers(len(host_fiber_vertices))]
 
         blender.particles.place(particle_clutter, position)
 
 
-def create_geometry(resolution):
+@profiling_utilities.profiled()
+def create_geometry(resolution, rng):
     diameter_minmax = [6, 50]
-    diameter = random.uniform(*diameter_minmax)
+    diameter = rng.uniform(*diameter_minmax)
 
-    fibers = create_fiber_fraction(diameter)
-    clutter = create_clutter_fraction(diameter)
+    fibers = create_fiber_fraction(diameter, rng)
+    clutter = create_clutter_fraction(diameter, rng)
 
-    place_fibers_randomly(fibers, resolution)
+    place_fibers_randomly(fibers, resolution, rng)
 
-    place_clutter_on_fibers(clutter, fibers)
+    place_clutter_on_fibers(clutter, fibers, rng)
     return fibers
 
 
-def setup_scene(resolution):
-    blender.scene.apply_default_settings(engine="CYCLES")
+def setup_scene(resolution, render_preset=None):
+    blender.scene.apply_default_settings(engine="CYCLES", preset=render_preset)
     blender.scene.set_resolution(resolution)
 
 
-def save_image(image, output_folder_path, image_id_string):
-    image_file_name = image_id_string + "_image.png"
-    image_file_path = os.path.join(output_folder_path, image_file_name)
-    image = image.convert("L")
-    image.save(image_file_path)
+def save_image(
+    image,
+    output_folder_path,
+    image_id_string,
+    writer=None,
+    output_format=None,
+):
+    if output_format is None:
+        output_format = output_utilities.DEFAULT_OUTPUT_FORMATS["image"]
 
+    image_file_name = image_id_string + "_image"
+    image_file_path = output_format.get_file_path(
+        os.path.join(output_folder_path, image_file_name)
+    )
+    # Copies the layer, whose buffer is reused for the next image.
+    image = compositing_utilities.layer_to_array(
+        image, dtype=_get_layer_dtype(output_format)
+    )
+    output_utilities.write(writer, output_format.save, image, image_file_path)
 
-def compose_layers(
-    background_layer, background_noise_layer, noise_layer, particle_layer
+    return image_file_path
+
+
+def save_debug_layers(
+    resolution, output_folder_path, image_id_string, writer, output_format
 ):
-    final_image = background_layer
-    final_image = Image.blend(final_image, background_noise_layer, 0.2)
-    final_image = Image.alpha_composite(final_image, particle_layer)
-    final_image = Image.blend(final_image, noise_layer, 0.2)
-    return final_image
+    """Save the layers of the image before composition."""
+    compositor = compositing_utilities.get_layer_compositor(resolution)
+    layer_file_paths = []
 
+    for layer_name, layer in compositor.buffers.items():
+        if layer_name == "composite":
+            continue
 
-def create_image_layers(resolution):
-    particle_layer = blender.scene.render_to_variable()
-    particle_layer = post_process_particle_layer(particle_layer)
-    background_layer = generate_gaussian_noise_image(
-        resolution,
-        scale=200,
-        strength=0.1,
-        contrast=0.2,
-        brightness=0.6,
+        layer_file_path = output_format.get_file_path(
+            os.path.join(output_folder_path, f"{image_id_string}_{layer_name}")
+        )
+        layer = compositing_utilities.layer_to_array(
+            layer, dtype=_get_layer_dtype(output_format)
+        )
+        output_utilities.write(
+            writer, output_format.save, layer, layer_file_path
+        )
+        layer_file_paths.append(layer_file_path)
+
+    return layer_file_paths
+
+
+def _get_layer_dtype(output_format):
+    # Keep the full precision of the layers for floating point formats.
+    if output_format.file_format == "exr":
+        return np.float32
+
+    return np.uint8
+
+
+@profiling_utilities.profiled("compositing")
+def compose_layers(
+    compositor,
+    background_layer,
+    background_noise_layer,
+    noise_layer,
+    particle_layer,
+):
+    return compositor.compose(
+        background_layer,
+        [
+            ("blend", background_noise_layer, 0.2),
+            ("alpha_composite", particle_layer),
+            ("blend", noise_layer, 0.2),
+        ],
     )
-    background_noise_layer = generate_gaussian_noise_image(
-        resolution,
-        scale=20,
-        strength=0.1,
-        contrast=0.2,
-        brightness=0.6,
+
+
+@profiling_utilities.profiled()
+def create_image_layers(compositor, rng, noise_banks=None):
+    particle_layer = compositor.image_layer(
+        "particles", blender.scene.render_to_variable()
     )
-    noise_layer = generate_gaussian_noise_image(resolution, strength=0.075)
+    particle_layer = post_process_particle_layer(particle_layer)
+
+    background_layers = list()
+    for layer_name, noise_parameters in BACKGROUND_NOISE_PARAMETERS.items():
+        if noise_banks is None:
+            layer = compositor.noise_layer(
+                layer_name, rng=rng, **noise_parameters
+            )
+        else:
+            layer = compositor.bank_layer(
+                layer_name, noise_banks[layer_name], rng=rng
+            )
+        background_layers.append(layer)
+
+    background_layer, background_noise_layer = background_layers
+    noise_layer = compositor.noise_layer("noise", strength=0.075, rng=rng)
     return (
         background_layer,
         background_noise_layer,
@@ -225,15 +397,19 @@ def create_image_layers(resolution):
 
 
 def post_process_particle_layer(particle_layer):
-    particle_layer = ImageEnhance.Contrast(particle_layer).enhance(1.5)
-    particle_layer = ImageEnhance.Brightness(particle_layer).enhance(2.2)
-    particle_layer = particle_layer.filter(
-        ImageFilter.GaussianBlur(radius=1.5)
+    compositing_utilities.adjust_contrast(
+        particle_layer, 1.5, out=particle_layer
+    )
+    compositing_utilities.adjust_brightness(
+        particle_layer, 2.2, out=particle_layer
+    )
+    compositing_utilities.gaussian_blur(
+        particle_layer, sigma=1.5, out=particle_layer
     )
     return particle_layer
 
 
-def place_fibers_randomly(particles, resolution):
+def place_fibers_randomly(particles, resolution, rng):
     (
         lower_space_boundaries_xyz,
         upper_space_boundaries_xyz,
@@ -244,6 +420,7 @@ def place_fibers_randomly(particles, resolution):
         lower_space_boundaries_xyz,
         upper_space_boundaries_xyz,
         do_random_rotation=True,
+        rng=rng,
     )
 
 
@@ -262,4 +439,35 @@ if __name__ == "__main__":
         ROOT_DIR, "output", "+loops_+clutter_+overlaps (synthetic)"
     )
 
-    generate_samples(num_images, output_folder_path, resolution)
+    # One of blender.scene.SPLINE_FILE_FORMATS: "per_spline_csv" (one file
+    # per spline) or "csv", "parquet", "npz" (one file per image).
+    spline_file_format = "per_spline_csv"
+
+    # Draw the background layers from memory-mapped banks of pre-generated
+    # noise instead of synthesizing them for every image, e.g.
+    # os.path.join(ROOT_DIR, "cache", "noise_banks"). This is faster, but
+    # the noise of all images is drawn from num_noise_bank_layers layers.
+    # None synthesizes new noise for every image.
+    noise_bank_directory = None
+    num_noise_bank_layers = 32
+
+    # File formats of the image and debug (pre-composition layers) streams.
+    # Set via render.py, e.g. --image-file-format png:15 or
+    # --debug-file-format npy.
+    output_formats = get_output_formats()
+
+    # One of blender.scene.RENDER_PRESETS ("draft", "balanced" or "quality").
+    # Set via render.py, e.g. --preset balanced. None keeps the render
+    # settings of the scene.
+    render_preset = get_render_preset()
+
+    generate_samples(
+        num_images,
+        output_folder_path,
+        resolution,
+        spline_file_format,
+        noise_bank_directory,
+        num_noise_bank_layers,
+        output_formats,
+        render_preset,
+    )
@@ -1,9 +1,7 @@
-import random
 import sys
 from pathlib import Path
 
 import bpy
-import numpy as np
 
 C = bpy.context
 D = bpy.data
@@ -16,6 +14,17 @@ if str(root_dir) not in sys.path:
 
 import blender.particles  # isort:skip
 import blender.scene  # isort:skip
+import blender.utilities  # isort:skip
+import output_utilities  # isort:skip
+import profiling_utilities  # isort:skip
+from recipe_utilities import (  # isort:skip
+    get_image_ids,
+    get_image_random_generator,
+    get_output_formats,
+    get_render_preset,
+    get_seed_base,
+    get_worker_name,
+)
 
 
 # # Force reload in case you edit the source after you first start the blender session.
@@ -25,7 +34,18 @@ import blender.scene  # isort:skip
 # importlib.reload(blender.scene)
 
 # Settings
-blender.scene.apply_default_settings()
+# File formats of the image and mask streams. Set via render.py, e.g.
+# --image-file-format png:15 or --mask-file-format tiff:50:1bit.
+output_formats = get_output_formats()
+
+# One of blender.scene.RENDER_PRESETS ("draft", "balanced" or "quality"). Set
+# via render.py, e.g. --preset balanced. None keeps the render settings of
+# the scene.
+render_preset = get_render_preset()
+
+blender.scene.apply_default_settings(
+    output_format=output_formats["image"], preset=render_preset
+)
 
 resolution = (1032, 825)
 blender.scene.set_resolution(resolution)
@@ -39,76 +59,197 @@ primitive_path_dark = root_dir / "primitives" / "sopat_catalyst" / "dark.blend"
 
 n_images = 10
 
-rng = np.random.default_rng(42)
+# Number of pre-baked shape variants per primitive. Fewer variants render
+# faster but yield less diverse particles. None randomizes every particle.
+num_shape_variants = None
+shape_variant_cache_directory = root_dir / "cache" / "shape_variants"
 
-uniform_distribution_float = rng.uniform
-uniform_distribution_integer = rng.integers
+# One of "relax_collisions" (rigid body simulation), or the faster, purely
+# geometric "random_sequential_addition" and "repulsion".
+placement_method = "relax_collisions"
 
-n_min_max_dark = [250, 350]
-n_min_max_light = [25, 50]
-
-d_g_min_max = [50, 70]
-sigma_g_min_max = [1.3, 1.7]
-
-for image_id in range(n_images):
-    with blender.scene.TemporaryState():
-        primitive_dark = blender.particles.load_primitive(primitive_path_dark)
-        primitive_light = blender.particles.load_primitive(
-            primitive_path_light
-        )
+# Fraction of the image, which is covered by the projected bounding spheres
+# of the particles (geometric placement methods only). If set, it replaces
+# the particle numbers: the maxima of n_min_max_dark and n_min_max_light are
+# generated, shuffled and only as many of them are kept, as are needed for
+# the coverage. None uses the particle numbers.
+target_coverage = None
 
-        # Ensure reproducibility of the psd.
-        random.seed(image_id)
+assert (
+    target_coverage is None or placement_method != "relax_collisions"
+), "target_coverage requires a geometric placement method."
 
-        # Create fraction 1: dark particles
-        name = "dark"
-        n = uniform_distribution_integer(*n_min_max_dark)
-        d_g = uniform_distribution_float(*d_g_min_max)
-        sigma_g = uniform_distribution_float(*sigma_g_min_max)
-        particles_dark = blender.particles.generate_lognormal_fraction(
-            primitive_dark, name, n, d_g, sigma_g, particle_class="dark"
-        )
+# One of "png" (one file per mask), "coco" (run-length encoded masks in one
+# json file per image) or "label" (one 16 bit instance label image per image).
+mask_format = "png"
 
-        # Create fraction 2: light particles
-        name = "light"
-        n = uniform_distribution_integer(*n_min_max_light)
-        d_g = uniform_distribution_float(*d_g_min_max)
-        sigma_g = uniform_distribution_float(*sigma_g_min_max)
-        particles_light = blender.particles.generate_lognormal_fraction(
-            primitive_light, name, n, d_g, sigma_g, particle_class="light"
-        )
+# One of "render" (Workbench renderer) or "rasterize" (numpy rasterization of
+# the projected meshes, which needs no render engine, e.g. on headless
+# servers).
+mask_backend = "render"
 
-        # Combine fractions.
-        particles = particles_dark + particles_light
+n_min_max_dark = [250, 350]
+n_min_max_light = [25, 50]
 
-        # Place particles.
-        n_frames = 10
-        lower_space_boundaries_xyz = (
-            -resolution[0] / 2,
-            -resolution[1] / 2,
-            -10,
-        )
-        upper_space_boundaries_xyz = (resolution[0] / 2, resolution[1] / 2, 10)
-        damping = 1
-        collision_shape = "sphere"
-
-        blender.particles.place_randomly(
-            particles,
-            lower_space_boundaries_xyz,
-            upper_space_boundaries_xyz,
-            do_random_rotation=True,
-        )
+d_g_min_max = [50, 70]
+sigma_g_min_max = [1.3, 1.7]
 
-        blender.particles.relax_collisions(
-            particles, damping, collision_shape, n_frames
+output_root = root_dir / "output" / "sopat" / "clean"
+
+# Skip images that were completed by a previous, interrupted run.
+manifest = output_utilities.Manifest(output_root)
+seed_base = get_seed_base()
+
+blender.utilities.count_operator_calls()
+
+# Write the masks of an image, while the next one is being rendered.
+with output_utilities.OutputWriter() as writer:
+    for image_id in get_image_ids(n_images, manifest):
+        # Seed every image individually, so that its content does not depend on
+        # which worker renders it.
+        rng = get_image_random_generator(image_id)
+
+        uniform_distribution_float = rng.uniform
+        uniform_distribution_integer = rng.integers
+
+        with profiling_utilities.profile_image(
+            image_id
+        ), blender.scene.TemporaryState():
+            primitive_dark = blender.particles.load_primitive(
+                primitive_path_dark
+            )
+            primitive_light = blender.particles.load_primitive(
+                primitive_path_light
+            )
+
+            shape_variants_dark = None
+            shape_variants_light = None
+
+            if num_shape_variants is not None:
+                shape_variants_dark = blender.particles.get_shape_variants(
+                    primitive_dark,
+                    num_shape_variants,
+                    shape_variant_cache_directory,
+                )
+                shape_variants_light = blender.particles.get_shape_variants(
+                    primitive_light,
+                    num_shape_variants,
+                    shape_variant_cache_directory,
+                )
+
+            # Create fraction 1: dark particles
+            name = "dark"
+            if target_coverage is None:
+                n = uniform_distribution_integer(*n_min_max_dark)
+            else:
+                n = n_min_max_dark[1]
+            d_g = uniform_distribution_float(*d_g_min_max)
+            sigma_g = uniform_distribution_float(*sigma_g_min_max)
+            particles_dark = blender.particles.generate_lognormal_fraction(
+                primitive_dark,
+                name,
+                n,
+                d_g,
+                sigma_g,
+                particle_class="dark",
+                shape_variants=shape_variants_dark,
+                rng=rng,
+            )
+
+            # Create fraction 2: light particles
+            name = "light"
+            if target_coverage is None:
+                n = uniform_distribution_integer(*n_min_max_light)
+            else:
+                n = n_min_max_light[1]
+            d_g = uniform_distribution_float(*d_g_min_max)
+            sigma_g = uniform_distribution_float(*sigma_g_min_max)
+            particles_light = blender.particles.generate_lognormal_fraction(
+                primitive_light,
+                name,
+                n,
+                d_g,
+                sigma_g,
+                particle_class="light",
+                shape_variants=shape_variants_light,
+                rng=rng,
+            )
+
+            # Combine fractions.
+            particles = particles_dark + particles_light
+
+            # Place particles.
+            n_frames = 10
+            lower_space_boundaries_xyz = (
+                -resolution[0] / 2,
+                -resolution[1] / 2,
+                -10,
+            )
+            upper_space_boundaries_xyz = (
+                resolution[0] / 2,
+                resolution[1] / 2,
+                10,
+            )
+            damping = 1
+            collision_shape = "sphere"
+
+            if placement_method == "relax_collisions":
+                blender.particles.place_randomly(
+                    particles,
+                    lower_space_boundaries_xyz,
+                    upper_space_boundaries_xyz,
+                    do_random_rotation=True,
+                    rng=rng,
+                )
+
+                blender.particles.relax_collisions(
+                    particles, damping, collision_shape, n_frames
+                )
+            else:
+                if target_coverage is not None:
+                    # Keep both fractions in proportion to their numbers.
+                    rng.shuffle(particles)
+
+                particles, _ = blender.particles.place_without_overlaps(
+                    particles,
+                    lower_space_boundaries_xyz,
+                    upper_space_boundaries_xyz,
+                    method=placement_method,
+                    target_coverage=target_coverage,
+                    do_random_rotation=True,
+                    rng=rng,
+                )
+
+            # Render and save current image and masks.
+            image_file_name = f"image_{image_id}.png"
+            image_file_path = output_root / image_file_name
+            image_file_path = blender.scene.save_render(
+                image_file_path, output_formats["image"]
+            )
+
+            mask_file_paths = blender.scene.render_occlusion_masks(
+                particles,
+                image_id,
+                output_root,
+                mask_format=mask_format,
+                writer=writer,
+                output_format=output_formats["mask"],
+                backend=mask_backend,
+            )
+            # blender.scene.render_object_masks(
+            #     particles, image_id, output_root
+            # )
+
+        # Record the image, once all of its files are written.
+        output_utilities.write_after_pending(
+            writer,
+            manifest.record,
+            image_id,
+            seed_base,
+            [image_file_path] + mask_file_paths,
         )
 
-        # Render and save current image and masks.
-        output_root = root_dir / "output" / "sopat" / "clean"
-
-        image_file_name = f"image_{image_id}.png"
-        image_file_path = output_root / image_file_name
-        blender.scene.render_to_file(image_file_path)
-
-        blender.scene.render_occlusion_masks(particles, image_id, output_root)
-        # blender.scene.render_object_masks(particles, image_id, output_root)
+# Summarize with: python profiling_utilities.py -d output/sopat/profile
+profiling_utilities.write_report(
+    root_dir / "output" / "sopat" / "profile", f"profile_{get_worker_name()}"
+)
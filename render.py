@@ -9,17 +9,54 @@ from setup_synthpic import (
     get_blender_executable_path,
     install_dependencies,
 )
-from system_utilities import execute_and_print
+from system_utilities import (
+    execute_and_print,
+    execute_and_print_in_parallel,
+    parse_shard_string,
+)
 
 
 def print_help():
     print("Usage:")
     print("render.py -s <scenefile> -r <recipefile>")
     print("render.py --scene <scenefile> --recipe <recipefile>")
+    print("")
+    print("Options:")
+    print("  -w, --workers <n>       Number of parallel Blender processes.")
+    print("  --shard <i>/<n>         Only render the i-th of n image shards.")
+    print("  --seed-base <seed>      Offset of the per-image random seeds.")
+    print("  --preset <preset>       Render performance preset: draft,")
+    print("                          balanced or quality (default: none).")
+    print("  --image-file-format <f> File format of images, masks and debug")
+    print("  --mask-file-format <f>  output: <format>[:<compression>][:1bit]")
+    print("  --debug-file-format <f> with format png, webp, tiff, exr or npy")
+    print("                          and compression in percent (0-100),")
+    print("                          e.g. png:15 or tiff:50:1bit (1 bit")
+    print("                          packing for masks only).")
     sys.exit(2)
 
 
-def render(scene_path, recipe_path):
+def get_threads_per_worker(num_workers):
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def render(
+    scene_path,
+    recipe_path,
+    num_workers=1,
+    shard=(0, 1),
+    seed_base=0,
+    output_formats=None,
+    preset=None,
+):
+    """Render a recipe in num_workers Blender processes.
+
+    output_formats maps output streams (image, mask, debug) to format
+    strings, which are passed to the recipe (see
+    output_utilities.parse_output_format). preset is the name of the render
+    performance preset, which is passed to the recipe (see
+    blender.scene.RENDER_PRESETS).
+    """
     recipe_path = os.path.abspath(recipe_path)
     scene_path = os.path.abspath(scene_path)
 
@@ -39,7 +76,12 @@ def render(scene_path, recipe_path):
 
     print("Rendering")
     print("Scene: {}".format(scene_path))
-    print("Recipe: {}\n".format(recipe_path))
+    print("Recipe: {}".format(recipe_path))
+    print("Shard: {}/{}".format(*shard))
+    print("Workers: {}".format(num_workers))
+    print("Preset: {}\n".format(preset or "none"))
+
+    assert num_workers > 0, "Expected a positive number of workers."
 
     blender_executable_path = get_blender_executable_path()
 
@@ -63,26 +105,77 @@ def render(scene_path, recipe_path):
                 print("Aborting.")
                 sys.exit()
 
-    execute_and_print(
-        [
+    shard_string = "{}/{}".format(*shard)
+
+    cmds = []
+
+    for worker_id in range(num_workers):
+        cmd = [
             blender_executable_path,
             "-noaudio",
             scene_path,
             "--background",
             "--factory-startup",
+        ]
+
+        if num_workers > 1:
+            # Prevent the workers from competing for the same cores.
+            cmd += ["--threads", str(get_threads_per_worker(num_workers))]
+
+        cmd += [
             "--python",
             recipe_path,
+            "--",
+            "--shard",
+            shard_string,
+            "--worker",
+            f"{worker_id}/{num_workers}",
+            "--seed-base",
+            str(seed_base),
         ]
-    )
+
+        for stream, format_string in (output_formats or {}).items():
+            cmd += [f"--{stream}-file-format", format_string]
+
+        if preset is not None:
+            cmd += ["--preset", preset]
+
+        cmds.append(cmd)
+
+    if num_workers == 1:
+        execute_and_print(cmds[0])
+    else:
+        prefixes = [
+            f"\t[worker {worker_id}] " for worker_id in range(num_workers)
+        ]
+        execute_and_print_in_parallel(cmds, prefixes)
 
 
 def main(argv):
     recipe_path = None
     scene_path = None
+    num_workers = 1
+    shard = (0, 1)
+    seed_base = 0
+    output_formats = dict()
+    preset = None
 
     try:
         opts, args = getopt.getopt(
-            argv, "hr:s:", ["help", "recipe=", "scene="]
+            argv,
+            "hr:s:w:",
+            [
+                "help",
+                "recipe=",
+                "scene=",
+                "workers=",
+                "shard=",
+                "seed-base=",
+                "preset=",
+                "image-file-format=",
+                "mask-file-format=",
+                "debug-file-format=",
+            ],
         )
     except getopt.GetoptError as err:
         print(err)
@@ -96,6 +189,16 @@ def main(argv):
             recipe_path = arg
         elif opt in ("-s", "--scene"):
             scene_path = arg
+        elif opt in ("-w", "--workers"):
+            num_workers = int(arg)
+        elif opt == "--shard":
+            shard = parse_shard_string(arg)
+        elif opt == "--seed-base":
+            seed_base = int(arg)
+        elif opt == "--preset":
+            preset = arg
+        elif opt.endswith("-file-format"):
+            output_formats[opt[2 : -len("-file-format")]] = arg
 
     assert (
         recipe_path is not None
@@ -104,7 +207,15 @@ def main(argv):
         scene_path is not None
     ), "No scene path was specified. Type 'python render.py -h' for help."
 
-    render(scene_path, recipe_path)
+    render(
+        scene_path,
+        recipe_path,
+        num_workers,
+        shard,
+        seed_base,
+        output_formats,
+        preset,
+    )
 
 
 if __name__ == "__main__":
@@ -1,9 +1,6 @@
-import warnings
-
 import numpy as np
 import pandas as pd
-from scipy import integrate, interpolate
-from scipy.integrate import AccuracyWarning
+from scipy import interpolate
 
 
 def _remove_duplicate_vertices(vertices):
@@ -28,19 +25,56 @@ def _prepare_spline_interpolation(vertices):
     return tck
 
 
-def calculate_spline_length(vertices):
-    tck = _prepare_spline_interpolation(vertices)
+def _integrate_spline_speed(tck, order):
+    # Composite Gauss-Legendre quadrature over the knot spans, where the
+    # spline (and therefore its speed) is smooth.
+    breakpoints = np.unique(np.clip(tck[0], 0, 1))
+    lower_bounds = breakpoints[:-1, np.newaxis]
+    upper_bounds = breakpoints[1:, np.newaxis]
+
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    half_widths = (upper_bounds - lower_bounds) / 2
+    nodes = lower_bounds + half_widths * (nodes + 1)
+    weights = half_widths * weights
+
+    derivatives = np.array(interpolate.splev(nodes.ravel(), tck, der=1))
+    speeds = np.sqrt(np.sum(derivatives ** 2, axis=0))
+
+    return np.dot(speeds, weights.ravel())
+
+
+def calculate_spline_lengths(
+    vertices_sets, tolerance=1e-6, initial_order=8, max_order=128
+):
+    """Calculate the lengths of splines through many sets of vertices.
+
+    The speed of each spline is integrated with Gauss-Legendre quadrature,
+    whose order is doubled until the relative change of the length drops
+    below tolerance or max_order is reached.
+    """
+    lengths = np.zeros(len(vertices_sets))
+
+    for spline_id, vertices in enumerate(vertices_sets):
+        tck = _prepare_spline_interpolation(vertices)
+
+        if tck is None:
+            continue
+
+        order = initial_order
+        length = _integrate_spline_speed(tck, order)
+
+        while order < max_order:
+            order *= 2
+            previous_length = length
+            length = _integrate_spline_speed(tck, order)
+
+            if abs(length - previous_length) <= tolerance * length:
+                break
 
-    if tck is None:
-        return 0
+        lengths[spline_id] = length
 
-    def length_function(u):
-        derivatives = interpolate.splev(u, tck, der=1)
-        derivatives = np.array(derivatives)
-        return np.sqrt(np.sum(derivatives ** 2))
+    return lengths
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", AccuracyWarning)
-        length = integrate.romberg(length_function, 0, 1)
 
-    return length
+def calculate_spline_length(vertices, tolerance=1e-6):
+    return calculate_spline_lengths([vertices], tolerance)[0]
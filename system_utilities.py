@@ -1,4 +1,5 @@
 import subprocess
+import threading
 
 
 def execute(cmd):
@@ -13,6 +14,61 @@ def execute(cmd):
         raise subprocess.CalledProcessError(return_code, cmd)
 
 
-def execute_and_print(cmd):
+def execute_and_print(cmd, prefix="\t", print_lock=None):
     for line in execute(cmd):
-        print("\t" + line.rstrip())
+        if print_lock is None:
+            print(prefix + line.rstrip())
+        else:
+            with print_lock:
+                print(prefix + line.rstrip())
+
+
+def execute_and_print_in_parallel(cmds, prefixes):
+    assert len(cmds) == len(prefixes), "Expected one prefix per command."
+
+    print_lock = threading.Lock()
+    errors = []
+
+    def worker(cmd, prefix):
+        try:
+            execute_and_print(cmd, prefix, print_lock)
+        except subprocess.CalledProcessError as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(target=worker, args=(cmd, prefix))
+        for cmd, prefix in zip(cmds, prefixes)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def parse_shard_string(shard_string):
+    try:
+        shard_index, num_shards = (int(x) for x in shard_string.split("/"))
+    except ValueError:
+        raise ValueError(
+            f"Expected shard in the form <index>/<count>, got {shard_string}."
+        )
+
+    assert num_shards > 0, "Expected a positive number of shards."
+    assert (
+        0 <= shard_index < num_shards
+    ), f"Expected shard index in [0, {num_shards}), got {shard_index}."
+
+    return shard_index, num_shards
+
+
+def split_range(sequence, shard_index, num_shards):
+    """Return the shard_index-th of num_shards contiguous, disjoint chunks."""
+    num_elements = len(sequence)
+    start = num_elements * shard_index // num_shards
+    stop = num_elements * (shard_index + 1) // num_shards
+    return sequence[start:stop]
@@ -0,0 +1,37 @@
+import numpy as np
+from PIL import Image
+
+import mask_utilities
+
+
+def test_save_label_image_without_masks(tmp_path):
+    label_file_path, class_file_path = mask_utilities.save_masks(
+        [], [], 0, tmp_path, "label", image_shape=(4, 6)
+    )
+
+    label_image = np.asarray(Image.open(label_file_path))
+
+    assert label_image.shape == (4, 6)
+    assert not label_image.any()
+
+    with open(class_file_path) as class_file:
+        assert class_file.read() == "instance_id,class\n"
+
+
+def test_save_label_image_without_masks_and_shape(tmp_path):
+    assert mask_utilities.save_masks([], [], 0, tmp_path, "label") == []
+    assert not list(tmp_path.iterdir())
+
+
+def test_save_label_image(tmp_path):
+    masks = np.zeros((2, 4, 6), dtype=bool)
+    masks[0, :2] = True
+    masks[1, 3, 1:] = True
+
+    label_file_path, _ = mask_utilities.save_masks(
+        masks, ["a", "b"], 0, tmp_path, "label"
+    )
+
+    label_image = np.asarray(Image.open(label_file_path))
+
+    np.testing.assert_array_equal(label_image, masks[0] + masks[1] * 2)
@@ -0,0 +1,22 @@
+import pytest
+
+import output_utilities
+
+
+def test_parse_output_format():
+    output_format = output_utilities.parse_output_format(
+        "tiff:50:1bit", "mask"
+    )
+
+    assert output_format.file_format == "tiff"
+    assert output_format.compression == 50
+    assert output_format.pack_bits
+
+
+@pytest.mark.parametrize(
+    "format_string, stream",
+    [("tiff:50:1bit", "image"), ("png:1bit", "debug"), ("webp:1bit", "mask")],
+)
+def test_parse_output_format_rejects_bit_packing(format_string, stream):
+    with pytest.raises(ValueError):
+        output_utilities.parse_output_format(format_string, stream)
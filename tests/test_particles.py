@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+bpy = pytest.importorskip("bpy")
+
+import blender.particles  # noqa: E402  isort:skip
+
+
+@pytest.fixture
+def hair_particle():
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    bpy.ops.mesh.primitive_plane_add(size=2)
+
+    particle = bpy.context.object
+    particle.location = (1, 2, 3)
+    particle.rotation_euler = (0.3, 0.2, 0.1)
+    particle.scale = (2, 1, 1.5)
+
+    particle.modifiers.new("hair", "PARTICLE_SYSTEM")
+    settings = particle.particle_systems[0].settings
+    settings.type = "HAIR"
+    settings.count = 20
+    settings.hair_step = 5
+    settings.display_step = 3
+
+    # Edit the hair once, so that bent keys are kept.
+    bpy.ops.object.mode_set(mode="PARTICLE_EDIT")
+    bpy.ops.object.mode_set(mode="OBJECT")
+
+    rng = np.random.default_rng(0)
+
+    for strand in particle.particle_systems[0].particles:
+        keys = np.empty(len(strand.hair_keys) * 3)
+        strand.hair_keys.foreach_get("co_local", keys)
+        keys = keys.reshape(-1, 3)
+        keys[1:] += rng.normal(0, 0.2, keys[1:].shape)
+        strand.hair_keys.foreach_set("co_local", keys.ravel())
+
+    bpy.context.view_layer.update()
+
+    return particle
+
+
+def _get_co_hair_vertices(particle):
+    particle_evaluated = particle.evaluated_get(
+        bpy.context.evaluated_depsgraph_get()
+    )
+    particle_system = particle_evaluated.particle_systems[0]
+    num_steps = 2 ** particle_system.settings.display_step + 1
+
+    return np.array(
+        [
+            particle_system.co_hair(
+                particle_evaluated, particle_no=strand_id, step=step
+            )
+            for strand_id in blender.particles._get_hair_strand_ids(
+                particle_system
+            )
+            for step in range(num_steps)
+        ]
+    )
+
+
+def test_hair_spline_vertices_match_co_hair(hair_particle):
+    settings = hair_particle.particle_systems[0].settings
+    settings.child_type = "INTERPOLATED"
+    settings.kink = "CURL"
+    bpy.context.view_layer.update()
+
+    (vertices,) = blender.particles.get_hair_spline_vertices(
+        hair_particle, use_cache=False
+    )
+
+    np.testing.assert_allclose(
+        vertices, _get_co_hair_vertices(hair_particle), atol=1e-5
+    )
+
+
+def test_hair_spline_vertices_are_cached_until_moved(hair_particle):
+    blender.particles.clear_geometry_cache()
+
+    (vertices,) = blender.particles.get_hair_spline_vertices(hair_particle)
+    (cached_vertices,) = blender.particles.get_hair_spline_vertices(
+        hair_particle
+    )
+
+    assert cached_vertices is vertices
+
+    hair_particle.location.x += 1
+    bpy.context.view_layer.update()
+
+    (moved_vertices,) = blender.particles.get_hair_spline_vertices(
+        hair_particle
+    )
+
+    np.testing.assert_allclose(
+        moved_vertices[:, 0], vertices[:, 0] + 1, atol=1e-5
+    )
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+bpy = pytest.importorskip("bpy")
+
+import blender.scene  # noqa: E402  isort:skip
+
+
+@pytest.fixture
+def filmic_scene(tmp_path):
+    bpy.ops.wm.read_factory_settings(use_empty=False)
+
+    scene = bpy.context.scene
+    scene.render.engine = "CYCLES"
+    scene.cycles.samples = 4
+    scene.cycles.device = "CPU"
+    scene.render.resolution_x = 64
+    scene.render.resolution_y = 48
+    scene.render.resolution_percentage = 100
+    scene.render.film_transparent = True
+    # Dither is not applied to the viewer node pixels.
+    scene.render.dither_intensity = 0
+
+    # Produce highlights, which the view transform compresses.
+    bpy.data.lights[0].energy = 3000
+
+    scene.view_settings.view_transform = "Filmic"
+
+    return scene
+
+
+def _read_image_pixels(file_path):
+    image = bpy.data.images.load(str(file_path))
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(image.size[1], image.size[0], 4)[::-1].copy()
+    bpy.data.images.remove(image)
+    return pixels
+
+
+def _save_render_result(file_path, file_format, color_depth):
+    image_settings = bpy.context.scene.render.image_settings
+    image_settings.file_format = file_format
+    image_settings.color_mode = "RGBA"
+    image_settings.color_depth = color_depth
+    bpy.data.images["Render Result"].save_render(str(file_path))
+
+
+def test_display_transform_matches_blender_for_filmic(filmic_scene, tmp_path):
+    pytest.importorskip("PyOpenColorIO")
+
+    display_transform = blender.scene._get_display_transform()
+    assert display_transform is not None
+
+    bpy.ops.render.render()
+
+    # Linear, premultiplied pixels like the ones of the viewer node.
+    _save_render_result(tmp_path / "linear.exr", "OPEN_EXR", "32")
+    linear_pixels = _read_image_pixels(tmp_path / "linear.exr")
+
+    _save_render_result(tmp_path / "image.png", "PNG", "8")
+    expected = np.round(
+        _read_image_pixels(tmp_path / "image.png") * 255
+    ).astype(int)
+
+    pixels = blender.scene._convert_viewer_pixels(
+        linear_pixels, display_transform
+    ).astype(int)
+
+    assert np.abs(pixels - expected).max() <= 1
+
+
+def test_display_transform_falls_back_for_exposure(filmic_scene):
+    filmic_scene.view_settings.exposure = 1
+
+    assert blender.scene._get_display_transform() is None
+
+
+def test_render_to_variable_uses_viewer_pixels_for_filmic(
+    filmic_scene, monkeypatch
+):
+    pytest.importorskip("PyOpenColorIO")
+
+    expected = blender.scene._render_to_temporary_file()
+
+    viewer_pixels = blender.scene._render_to_viewer_pixels(
+        blender.scene._get_display_transform()
+    )
+
+    if viewer_pixels is None:
+        pytest.skip("This Blender version does not update the viewer node.")
+
+    def fail():
+        raise AssertionError("Rendered to a temporary file.")
+
+    monkeypatch.setattr(blender.scene, "_render_to_temporary_file", fail)
+
+    pixels = blender.scene.render_to_variable()
+
+    assert np.abs(pixels.astype(int) - expected.astype(int)).max() <= 1